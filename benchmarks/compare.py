@@ -0,0 +1,34 @@
+import argparse
+import json
+
+CONFIG = ['dataset', 'size', 'tokenizer', 'threshold', 'join', 'algorithm']
+
+
+def _load(path: str):
+    with open(path) as f:
+        return {tuple(r[k] for k in CONFIG): r for r in json.load(f)['results']}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare two benchmark runs")
+    parser.add_argument('base')
+    parser.add_argument('new')
+    args = parser.parse_args()
+
+    base, new = _load(args.base), _load(args.new)
+    print(f"{'configuration':<60} {'base s':>9} {'new s':>9} {'ratio':>7} {'base MB':>8} {'new MB':>8}")
+    for key in sorted(base.keys() & new.keys(), key=str):
+        b, n = base[key], new[key]
+        # a changed result size means one of the two runs is not exact
+        flag = '' if b['results'] == n['results'] else f"  results {b['results']} -> {n['results']}"
+        print(
+            f"{' '.join(str(k) for k in key):<60} {b['total_s']:>9.3f} {n['total_s']:>9.3f} "
+            f"{n['total_s'] / b['total_s'] if b['total_s'] else float('nan'):>7.2f} "
+            f"{b['peak_rss_mb']:>8.0f} {n['peak_rss_mb']:>8.0f}{flag}"
+        )
+    for key in sorted(base.keys() ^ new.keys(), key=str):
+        print(f"{' '.join(str(k) for k in key):<60} only in {'base' if key in base else 'new'}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+import os
+
+import duckdb
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data')
+
+NCVR_FIELDS = [
+    "entity", "rec_id", "first_name", "last_name", "sex", "age", "birth_place", "house_num", "county_desc",
+    "street_name", "zip_code", "phone_num"
+]
+NCVR_FILES = ["NCVR_AF_clean.csv", "NCVR_BF_clean.csv", "NCVR_CF_clean.csv"]
+
+
+def _word(i: int):
+    # bijective base-26 spelling, so that distinct words never collide and q-grams overlap as in real text
+    letters = []
+    i += 26 ** 3
+    while i:
+        i, r = divmod(i - 1, 26)
+        letters.append(chr(ord('a') + r))
+    return ''.join(reversed(letters))
+
+
+def synthetic(
+        size: int,
+        vocabulary: int = 50_000,
+        skew: float = 1.0,
+        min_len: int = 3,
+        max_len: int = 12,
+        dup_rate: float = 0.1,
+        exact_dup_rate: float = 0.02,
+        edit_rate: float = 0.2,
+        seed: int = 0
+):
+    # records of min_len to max_len words drawn from a Zipf-like distribution (skew 0 is uniform)
+    # a dup_rate fraction are near duplicates of an earlier record, each word replaced with probability edit_rate,
+    # an exact_dup_rate fraction are verbatim copies; words go by two between commas, for the delimiter tokenizer
+    rnd = np.random.default_rng(seed)
+    words = np.array([_word(i) for i in range(vocabulary)], dtype=object)
+    p = 1.0 / np.arange(1, vocabulary + 1) ** skew
+    p /= p.sum()
+
+    lens = rnd.integers(min_len, max_len + 1, size)
+    records = np.split(rnd.choice(vocabulary, lens.sum(), p=p), np.cumsum(lens)[:-1])
+
+    kind = rnd.random(size)
+    for i in range(1, size):
+        if kind[i] < exact_dup_rate:
+            records[i] = records[rnd.integers(0, i)]
+        elif kind[i] < exact_dup_rate + dup_rate:
+            rec = records[rnd.integers(0, i)].copy()
+            edit = rnd.random(len(rec)) < edit_rate
+            rec[edit] = rnd.choice(vocabulary, edit.sum(), p=p)
+            records[i] = rec
+
+    vals = [
+        ', '.join(' '.join(words[rec[j:j + 2]]) for j in range(0, len(rec), 2))
+        for rec in records
+    ]
+    return pa.table({'id': [f"s{i}" for i in range(size)], 'val': vals})
+
+
+def ncvr(con: duckdb.DuckDBPyConnection, files=NCVR_FILES):
+    return con.execute(
+        " union all ".join(
+            f"select id, concat_ws(' ', {', '.join(NCVR_FIELDS)}) as val "
+            f"from read_csv('{os.path.join(DATA_DIR, f)}', all_varchar = true)"
+            for f in files
+        )
+    ).to_arrow_reader().read_all()
+
+
+def materialize(work_dir: str, dataset: str, size: int, **synthetic_args):
+    # the dataset is written once as Parquet, with the two halves of the inner join alongside
+    name = dataset
+    if dataset == 'synthetic':
+        name = '_'.join([name, str(size)] + [f"{k}{v}" for k, v in sorted(synthetic_args.items())])
+    paths = {side: os.path.join(work_dir, f"{name}_{side}.parquet") for side in ('all', 'l', 'r')}
+    if all(os.path.exists(p) for p in paths.values()):
+        return paths
+
+    if dataset == 'synthetic':
+        table = synthetic(size, **synthetic_args)
+    elif dataset == 'ncvr':
+        table = ncvr(duckdb.connect())
+    else:
+        raise ValueError(f"unknown dataset {dataset}")
+
+    # alternate rows, so that the duplicates spread across both sides of the inner join
+    pq.write_table(table, paths['all'])
+    pq.write_table(table.filter(pa.array(np.arange(table.num_rows) % 2 == 0)), paths['l'])
+    pq.write_table(table.filter(pa.array(np.arange(table.num_rows) % 2 == 1)), paths['r'])
+    return paths
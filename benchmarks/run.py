@@ -0,0 +1,119 @@
+import argparse
+import datetime
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import duckdb
+
+from benchmarks import datasets
+from py_duckdb.similarity_join import jaccard_join, jaccard_join_brute_force
+from py_duckdb.similarity_join import tokenizers
+
+
+def tokenizer(name: str):
+    if name.startswith('qgrams'):
+        return tokenizers.QGramsTokzr(int(name[len('qgrams'):]))
+    if name == 'whitespace':
+        return tokenizers.WhitespaceTokzr()
+    if name == 'delimiter':
+        return tokenizers.DelimiterTokzr([','])
+    raise ValueError(f"unknown tokenizer {name}")
+
+
+def _run(config: dict, paths: dict, repeat: int):
+    # runs in a fresh process, so that the peak RSS belongs to this configuration only
+    con = duckdb.connect()
+    con.execute(f"create table l as select * from read_parquet('{paths['all' if config['join'] == 'self' else 'l']}')")
+    con.execute(f"create table r as select * from read_parquet('{paths['r']}')")
+    r_table = '' if config['join'] == 'self' else 'r'
+    args = (con, 'l', r_table, 'id', 'id', 'val', 'val', tokenizer(config['tokenizer']), config['threshold'], 'out')
+
+    runs = []
+    for _ in range(repeat):
+        stats = {}
+        start = time.perf_counter()
+        if config['algorithm'] == 'brute_force':
+            jaccard_join_brute_force(*args, stats=stats)
+        else:
+            jaccard_join(*args, stats=stats, engine=config['algorithm'])
+        runs.append((time.perf_counter() - start, stats))
+
+    total, stats = min(runs, key=lambda run: run[0])
+    return {
+        **config,
+        'records': stats['rows']['records'],
+        'total_s': total,
+        'totals_s': [run[0] for run in runs],
+        'stages_s': stats['stages'],
+        'rows': stats['rows'],
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'written_bytes': stats.get('written_bytes'),
+        'candidates': stats['rows'].get('candidates'),
+        'results': stats['rows']['matches']
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Jaccard join benchmark sweep")
+    parser.add_argument('--datasets', nargs='+', default=['synthetic', 'ncvr'])
+    parser.add_argument('--sizes', nargs='+', type=int, default=[1_000, 10_000])
+    parser.add_argument('--thresholds', nargs='+', type=float, default=[0.5, 0.7, 0.9])
+    parser.add_argument('--tokenizers', nargs='+', default=['qgrams3', 'whitespace', 'delimiter'])
+    parser.add_argument('--joins', nargs='+', default=['self', 'inner'])
+    parser.add_argument('--algorithms', nargs='+', default=['sql', 'native', 'brute_force'])
+    parser.add_argument('--skew', type=float, default=1.0)
+    parser.add_argument('--dup-rate', type=float, default=0.1)
+    parser.add_argument('--exact-dup-rate', type=float, default=0.02)
+    parser.add_argument('--vocabulary', type=int, default=50_000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--work-dir', default=None, help="where the generated datasets are cached")
+    parser.add_argument('--out', default='bench_output.json')
+    args = parser.parse_args()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='jaccard_bench_')
+    os.makedirs(work_dir, exist_ok=True)
+
+    results = []
+    for dataset in args.datasets:
+        # the NCVR files have a fixed size
+        for size in (args.sizes if dataset == 'synthetic' else [None]):
+            paths = datasets.materialize(
+                work_dir, dataset, size, vocabulary=args.vocabulary, skew=args.skew, dup_rate=args.dup_rate,
+                exact_dup_rate=args.exact_dup_rate, seed=args.seed
+            )
+            for tk, t, join, algorithm in itertools.product(
+                    args.tokenizers, args.thresholds, args.joins, args.algorithms
+            ):
+                config = {
+                    'dataset': dataset, 'size': size, 'tokenizer': tk, 'threshold': t, 'join': join,
+                    'algorithm': algorithm
+                }
+                with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as pool:
+                    result = pool.submit(_run, config, paths, args.repeat).result()
+                print(json.dumps(result))
+                results.append(result)
+
+    with open(args.out, 'w') as out:
+        json.dump({
+            'meta': {
+                'date': datetime.datetime.now().isoformat(),
+                'duckdb': duckdb.__version__,
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'cpus': os.cpu_count(),
+                'args': vars(args)
+            },
+            'results': results
+        }, out, indent=2)
+
+
+if __name__ == '__main__':
+    main()
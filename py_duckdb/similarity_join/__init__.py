@@ -1,6 +1,12 @@
 import duckdb
-from py_duckdb.similarity_join.join.jaccard_join import jaccard_join, jaccard_join_brute_force
+from py_duckdb.similarity_join.join.jaccard_join import jaccard_join, jaccard_join_iter, jaccard_join_parallel, \
+    jaccard_join_sweep, jaccard_join_topk, jaccard_join_approximate, jaccard_join_brute_force
+from py_duckdb.similarity_join.join import bounds
+from py_duckdb.similarity_join.join.jaccard_index import JaccardIndex
+from py_duckdb.similarity_join.join.service import JaccardService
 from py_duckdb.similarity_join.tokenizers import QGramsTokzr, DelimiterTokzr, WhitespaceTokzr
+from py_duckdb.similarity_join.tokenizers.cache import TokenCache
+from py_duckdb.similarity_join.default_names import scratch_namespace
 
 
 def evaluate(
@@ -10,39 +16,93 @@ def evaluate(
         gt_l_key='l_id',
         gt_r_key='r_id',
         sj_l_key='l_id',
+        sj_r_key='r_id',
+        thresholds: list[float] = None,
+        sj_score='jaccard'
+):
+    # pairs are compared as (least, greatest) of their keys, so that either orientation matches on a plain
+    # equi-join, and duplicate pairs count once; tp, fp and fn all come out of one scan of the full outer join
+    # with thresholds, similarity_join_table is a scored join at the lowest of them (see jaccard_join_sweep), and
+    # the metrics of every threshold come out of that same scan, as a list in the order of thresholds; the scores
+    # are compared with the threshold as the joins do, so that they match a join at each threshold
+    # similarity_join_table may be any relation, e.g. read_parquet() over the shards of a partitioned output
+    counts = []
+    for t in (thresholds or [None]):
+        found = "sj.k1 is not null" if t is None else f"coalesce(sj.score >= {bounds.threshold_literal(t)}, false)"
+        counts += [
+            f"count(*) filter (where gt.k1 is not null and {found})",
+            f"count(*) filter (where gt.k1 is null and {found})",
+            f"count(*) filter (where gt.k1 is not null and not {found})"
+        ]
+    row = con.execute(
+        f"select {', '.join(counts)} "
+        f"from ({_normalized_pairs_query(ground_truth_table, gt_l_key, gt_r_key)}) gt "
+        "full outer join ("
+        + _normalized_pairs_query(similarity_join_table, sj_l_key, sj_r_key, sj_score if thresholds else None) +
+        ") sj "
+        "on gt.k1 = sj.k1 and gt.k2 = sj.k2"
+    ).fetchall()[0]
+
+    if not thresholds:
+        return _metrics(*row)
+    return [
+        {'threshold': t, **_metrics(*row[3 * i: 3 * i + 3])}
+        for i, t in enumerate(thresholds)
+    ]
+
+
+def evaluate_batches(
+        con: duckdb.DuckDBPyConnection,
+        ground_truth_table: str,
+        batches,
+        gt_l_key='l_id',
+        gt_r_key='r_id',
+        sj_l_key='l_id',
         sj_r_key='r_id'
 ):
-    con.execute("drop view if exists confusion_mtx").execute(
-        "create view confusion_mtx as "
-        f"select gt.{gt_l_key} as gtk1, gt.{gt_r_key} as gtk2, "
-        f"sj.{sj_l_key} as sjk1, sj.{sj_r_key} as sjk2 "
-        f"from {ground_truth_table} gt "
-        f"full outer join {similarity_join_table} sj "
-        f"on (gt.{gt_l_key} = sj.{sj_l_key} and gt.{gt_r_key} = sj.{sj_r_key}) "
-        f"or (gt.{gt_l_key} = sj.{sj_r_key} and gt.{gt_r_key} = sj.{sj_l_key})"
+    # scores a streamed join, e.g. the record batches of jaccard_join_iter, as they arrive and without keeping them:
+    # the batches hold disjoint pairs, so that the true positives of each one add up
+    gt = f"{scratch_namespace()}gt"
+    con.execute(
+        f"create temp table {gt} as " + _normalized_pairs_query(ground_truth_table, gt_l_key, gt_r_key)
     )
+    tp, fp = 0, 0
+    try:
+        for i, batch in enumerate(batches):
+            view = f"{gt}_batch"
+            con.register(view, batch)
+            try:
+                batch_tp, batch_fp = con.execute(
+                    "select count(gt.k1), count(*) - count(gt.k1) "
+                    f"from ({_normalized_pairs_query(view, sj_l_key, sj_r_key)}) sj "
+                    f"left join {gt} gt "
+                    "on gt.k1 = sj.k1 and gt.k2 = sj.k2"
+                ).fetchall()[0]
+            finally:
+                con.unregister(view)
+            tp += batch_tp
+            fp += batch_fp
+        fn = con.execute(f"select count(*) from {gt}").fetchall()[0][0] - tp
+    finally:
+        con.execute(f"drop table if exists {gt}")
 
-    tp = con.execute(
-        "select count(*) "
-        "from confusion_mtx "
-        "where sjk1 is not null "
-        "and sjk2 is not null "
-    ).fetchall()[0][0]
+    return _metrics(tp, fp, fn)
 
-    fp = con.execute(
-        "select count(*) "
-        "from confusion_mtx "
-        "where gtk1 is null "
-    ).fetchall()[0][0]
 
-    fn = con.execute(
-        "select count(*) "
-        "from confusion_mtx "
-        "where sjk1 is null "
-    ).fetchall()[0][0]
+def _normalized_pairs_query(table: str, l_key: str, r_key: str, score: str = None):
+    if score is None:
+        return (
+            f"select distinct least({l_key}, {r_key}) as k1, greatest({l_key}, {r_key}) as k2 "
+            f"from {table}"
+        )
+    return (
+        f"select least({l_key}, {r_key}) as k1, greatest({l_key}, {r_key}) as k2, max({score}) as score "
+        f"from {table} "
+        "group by all"
+    )
 
-    con.execute("drop view confusion_mtx")
 
+def _metrics(tp: int, fp: int, fn: int):
     pr = 0
     rc = 0
     fm = 0
@@ -1,5 +1,16 @@
+import uuid
+
 TOKENS_VIEW = "tokens"
 DOC_FREQ_VIEW = "df"
 TOKENS_DOC_FREQ_VIEW = "tkdf"
 PREFIXES_VIEW = "prefixes"
 CANDIDATE_SET_VIEW = "candset"
+SIGNATURES_VIEW = "signatures"
+MINHASHES_VIEW = "minhashes"
+BUCKETS_VIEW = "buckets"
+INDEX_META_VIEW = "meta"
+
+
+def scratch_namespace():
+    # a unique prefix for the intermediate tables of one join, so that concurrent joins on a database do not collide
+    return f"sj_{uuid.uuid4().hex[:12]}_"
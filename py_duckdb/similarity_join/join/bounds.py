@@ -0,0 +1,36 @@
+from decimal import Decimal
+from fractions import Fraction
+
+
+# every filter of the joins compares integers with the threshold exactly, so that a pair at exactly the threshold
+# (e.g. an overlap of 6 between 6 and 15 tokens at 0.4) is a match for every engine: the threshold is its decimal
+# literal, a DECIMAL in DuckDB, and the bounds are multiplied out instead of divided
+
+
+def threshold_literal(t: float):
+    return f"{Decimal(str(t)):f}"
+
+
+def integer_ratio(t: float):
+    # the threshold as p / q, for the native engine
+    return Fraction(Decimal(str(t))).as_integer_ratio()
+
+
+def overlap_at_least(overlap: str, l_len: str, r_len: str, t: float):
+    # overlap >= (l_len + r_len) * t / (1 + t), i.e. a Jaccard similarity of at least t
+    t = threshold_literal(t)
+    return f"({overlap}) * (1 + {t}) >= ({l_len} + {r_len}) * {t}"
+
+
+def in_indexing_prefix(length: str, pos: str, t: float):
+    # length - pos + 1 >= length * 2t / (1 + t)
+    t = threshold_literal(t)
+    return f"({length} - {pos} + 1) * (1 + {t}) >= {length} * 2 * {t}"
+
+
+def in_probing_prefix(length: str, pos: str, t: float):
+    return f"{length} - {pos} + 1 >= {length} * {threshold_literal(t)}"
+
+
+def length_at_least(length: str, partner_len: str, t: float):
+    return f"{length} >= {partner_len} * {threshold_literal(t)}"
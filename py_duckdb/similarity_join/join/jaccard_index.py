@@ -0,0 +1,340 @@
+import duckdb
+
+from py_duckdb.similarity_join import tokenizers
+from py_duckdb.similarity_join.join import bounds
+from py_duckdb.similarity_join.default_names import *
+
+
+class JaccardIndex:
+
+    @classmethod
+    def build(
+            cls,
+            con: duckdb.DuckDBPyConnection,
+            name: str,
+            table: str,
+            key_attr: str,
+            join_attr: str,
+            tokenizer: tokenizers.Tokenizer,
+            min_threshold: float
+    ):
+        index = cls.__new__(cls)
+        index._con = con
+        index._name = name
+        index._ns = scratch_namespace()
+        index._key_attr = key_attr
+        index._join_attr = join_attr
+        index._tokenizer = tokenizer
+        index._t = min_threshold
+
+        try:
+            index._build(table)
+        except Exception:
+            index.drop()
+            raise
+        return index
+
+    def _build(self, table: str):
+        self.drop()
+
+        # the tokenizer is persisted as its query template, so that the index can be reopened by name
+        self._con.execute(
+            f"create table {self._table(INDEX_META_VIEW)} "
+            "(key_attr varchar, join_attr varchar, tokenizer varchar, min_threshold double)"
+        ).execute(
+            f"insert into {self._table(INDEX_META_VIEW)} values (?, ?, ?, ?)",
+            [
+                self._key_attr, self._join_attr,
+                self._tokenizer.template(), self._t
+            ]
+        )
+
+        self._con.execute(
+            f"drop table if exists {self._table(TOKENS_VIEW)}"
+        ).execute(
+            f"create table {self._table(TOKENS_VIEW)} as " + self._tokenizer.query(
+                from_table=table,
+                key=self._key_attr, val=self._join_attr
+            )
+        )
+
+        # the global ordering is frozen in 'rank', probes and later insertions are ordered by the same ranks
+        # prefix filtering is correct under any total order of the tokens, as long as every record is sorted by
+        # the same one: the df ordering only makes prefixes more selective, so it may drift without losing matches
+        self._con.execute(
+            f"create table {self._table(DOC_FREQ_VIEW)} as "
+            "select token, df, row_number() over (order by df, token) as rank "
+            "from ( "
+            "select token, count(*) as df "
+            f"from {self._table(TOKENS_VIEW)} "
+            "group by token "
+            ") "
+        ).execute(
+            f"create table {self._table(TOKENS_DOC_FREQ_VIEW)} as "
+            f"select t.{self._key_attr} as id, t.len, d.rank as token "
+            f", row_number() over (partition by t.{self._key_attr} order by d.rank) as pos "
+            f"from {self._table(TOKENS_VIEW)} t, {self._table(DOC_FREQ_VIEW)} d "
+            "where t.token = d.token"
+        ).execute(
+            f"drop table {self._table(TOKENS_VIEW)}"
+        )
+
+        # the indexed records may be longer than the probes, hence the probing prefix (valid for any partner
+        # length) rather than the indexing one; it is the longest prefix needed by any threshold >= min_threshold
+        self._con.execute(
+            f"create table {self._table(PREFIXES_VIEW)} as "
+            "select id, len, token, pos "
+            f"from {self._table(TOKENS_DOC_FREQ_VIEW)} "
+            f"where {bounds.in_probing_prefix('len', 'pos', self._t)} "
+        )
+
+    def join(
+            self,
+            table: str,
+            key_attr: str,
+            join_attr: str,
+            threshold: float,
+            out_table: str,
+            l_out_prefix: str = 'l_',
+            r_out_prefix: str = 'r_'
+    ):
+        self._check_threshold(threshold)
+        try:
+            self._probe_tokenize(table, key_attr, join_attr)
+            self._probe_candidates(threshold)
+            self._probe_matches(threshold, key_attr, out_table, l_out_prefix, r_out_prefix)
+        finally:
+            self._scratch_clear()
+        return self._con
+
+    def probe_query(
+            self,
+            table: str,
+            key_attr: str,
+            join_attr: str,
+            threshold: float,
+            l_out_prefix: str = 'l_',
+            r_out_prefix: str = 'r_',
+            scores: bool = False
+    ):
+        # the probe join as a single query, without scratch tables: small probes spend most of a join() in DDL
+        self._check_threshold(threshold)
+        return (
+            f"with Stkdf as materialized ({self._probe_tokens_query(table, key_attr, join_attr)}), "
+            f"c as materialized ({self._probe_candidates_query(threshold, 'Stkdf')}) "
+            + self._probe_matches_query(threshold, key_attr, l_out_prefix, r_out_prefix, 'Stkdf', 'c', scores)
+        )
+
+    def _check_threshold(self, threshold: float):
+        if threshold < self._t:
+            raise ValueError(f"threshold {threshold} is below the index minimum threshold {self._t}")
+
+    def _probe_tokenize(self, table: str, key_attr: str, join_attr: str):
+        self._con.execute(
+            f"drop table if exists {self._scratch_table(TOKENS_DOC_FREQ_VIEW)}"
+        ).execute(
+            f"create temp table {self._scratch_table(TOKENS_DOC_FREQ_VIEW)} as "
+            + self._probe_tokens_query(table, key_attr, join_attr)
+        )
+
+    def _probe_tokens_query(self, table: str, key_attr: str, join_attr: str):
+        # tokens missing from the index cannot match, they take no rank and go at the end of the ordering
+        return (
+            f"select t.{key_attr} as id, t.len, d.rank as token "
+            f", row_number() over (partition by t.{key_attr} order by d.rank nulls last, t.token) as pos "
+            f"from ({self._tokenizer.query(from_table=table, key=key_attr, val=join_attr)}) t "
+            f"left join {self._table(DOC_FREQ_VIEW)} d "
+            "on t.token = d.token"
+        )
+
+    def _probe_candidates(self, threshold: float):
+        self._con.execute(
+            f"drop table if exists {self._scratch_table(CANDIDATE_SET_VIEW)}"
+        ).execute(
+            f"create temp table {self._scratch_table(CANDIDATE_SET_VIEW)} as "
+            + self._probe_candidates_query(threshold, self._scratch_table(TOKENS_DOC_FREQ_VIEW))
+        )
+
+    def _probe_candidates_query(self, threshold: float, probe_tokens: str):
+        return (
+            "select Rpfx.id as Rid, Spfx.id as Sid "
+            ", max(Rpfx.pos) as RmaxPos, max(Spfx.pos) as SmaxPos, count(*) as pfxOverlap "
+            f"from {self._table(PREFIXES_VIEW)} Rpfx, {probe_tokens} Spfx "
+            "where Rpfx.token = Spfx.token "
+            # prefix filter, the stored prefixes are cut at the index minimum threshold
+            f"and {bounds.in_probing_prefix('Rpfx.len', 'Rpfx.pos', threshold)} "
+            f"and {bounds.in_probing_prefix('Spfx.len', 'Spfx.pos', threshold)} "
+            # length filter
+            f"and {bounds.length_at_least('Rpfx.len', 'Spfx.len', threshold)} "
+            f"and {bounds.length_at_least('Spfx.len', 'Rpfx.len', threshold)} "
+            # positional filter
+            "and " + bounds.overlap_at_least(
+                "least((Rpfx.len - Rpfx.pos + 1), (Spfx.len - Spfx.pos + 1))", "Rpfx.len", "Spfx.len", threshold
+            ) + " "
+            "group by Rpfx.id, Spfx.id "
+        )
+
+    def _probe_matches(self, threshold: float, key_attr: str, out_table: str, l_out_prefix: str, r_out_prefix: str):
+        self._con.execute(
+            f"drop table if exists {out_table}"
+        ).execute(
+            f"create table {out_table} as " + self._probe_matches_query(
+                threshold, key_attr, l_out_prefix, r_out_prefix,
+                self._scratch_table(TOKENS_DOC_FREQ_VIEW), self._scratch_table(CANDIDATE_SET_VIEW)
+            )
+        )
+
+    def _probe_matches_query(
+            self,
+            threshold: float,
+            key_attr: str,
+            l_out_prefix: str,
+            r_out_prefix: str,
+            probe_tokens: str,
+            candidates: str,
+            scores: bool = False
+    ):
+        overlap = "(count(*) + pfxOverlap - 1)"
+        return (
+            f"select S.id as {l_out_prefix}{key_attr}, R.id as {r_out_prefix}{self._key_attr} "
+            + (f", {overlap} as overlap, {overlap} / (R.len + S.len - {overlap}) as jaccard " if scores else "") +
+            f"from {self._table(TOKENS_DOC_FREQ_VIEW)} R, {probe_tokens} S, {candidates} c "
+            "where c.Rid = R.id "
+            "and c.Sid = S.id "
+            "and R.token = S.token "
+            "and R.pos >= RmaxPos "
+            "and S.pos >= SmaxPos "
+            "group by R.id, S.id, R.len, S.len, pfxOverlap "
+            f"having {bounds.overlap_at_least(overlap, 'R.len', 'S.len', threshold)}"
+        )
+
+    def _scratch_clear(self):
+        self._con.execute(
+            f"drop table if exists {self._scratch_table(TOKENS_VIEW)};"
+            f"drop table if exists {self._scratch_table(TOKENS_DOC_FREQ_VIEW)};"
+            f"drop table if exists {self._scratch_table(CANDIDATE_SET_VIEW)};"
+        )
+
+    def insert(self, table: str):
+        try:
+            self._con.execute(
+                f"drop table if exists {self._scratch_table(TOKENS_VIEW)}"
+            ).execute(
+                f"create temp table {self._scratch_table(TOKENS_VIEW)} as " + self._tokenizer.query(
+                    from_table=table,
+                    key=self._key_attr, val=self._join_attr
+                )
+            )
+
+            # inserting an indexed key replaces its record, also with a value without tokens (e.g. null), which
+            # leaves no record; the keys come from table, as the tokens hold none of those
+            self._delete_keys(f"select {self._key_attr} from {table}")
+
+            self._con.execute(
+                f"update {self._table(DOC_FREQ_VIEW)} d "
+                "set df = d.df + delta.df "
+                "from ( "
+                "select token, count(*) as df "
+                f"from {self._scratch_table(TOKENS_VIEW)} "
+                "group by token "
+                ") delta "
+                "where d.token = delta.token"
+            ).execute(
+                # new tokens are ranked after all the known ones, leaving the positions of indexed records untouched
+                f"insert into {self._table(DOC_FREQ_VIEW)} "
+                "select token, df "
+                f", (select coalesce(max(rank), 0) from {self._table(DOC_FREQ_VIEW)}) "
+                "+ row_number() over (order by df, token) as rank "
+                "from ( "
+                "select t.token, count(*) as df "
+                f"from {self._scratch_table(TOKENS_VIEW)} t "
+                f"anti join {self._table(DOC_FREQ_VIEW)} d "
+                "on t.token = d.token "
+                "group by t.token "
+                ") "
+            )
+
+            self._con.execute(
+                f"insert into {self._table(TOKENS_DOC_FREQ_VIEW)} "
+                f"select t.{self._key_attr} as id, t.len, d.rank as token "
+                f", row_number() over (partition by t.{self._key_attr} order by d.rank) as pos "
+                f"from {self._scratch_table(TOKENS_VIEW)} t, {self._table(DOC_FREQ_VIEW)} d "
+                "where t.token = d.token"
+            ).execute(
+                f"insert into {self._table(PREFIXES_VIEW)} "
+                "select tkdf.id, tkdf.len, tkdf.token, tkdf.pos "
+                f"from {self._table(TOKENS_DOC_FREQ_VIEW)} tkdf "
+                f"semi join {self._scratch_table(TOKENS_VIEW)} t "
+                f"on tkdf.id = t.{self._key_attr} "
+                f"where {bounds.in_probing_prefix('tkdf.len', 'tkdf.pos', self._t)} "
+            )
+        finally:
+            self._scratch_clear()
+        return self._con
+
+    def delete(self, table: str, key_attr: str = None):
+        self._delete_keys(f"select {key_attr or self._key_attr} from {table}")
+        return self._con
+
+    def _delete_keys(self, keys_query: str):
+        self._con.execute(
+            f"update {self._table(DOC_FREQ_VIEW)} d "
+            "set df = d.df - delta.df "
+            "from ( "
+            "select token, count(*) as df "
+            f"from {self._table(TOKENS_DOC_FREQ_VIEW)} "
+            f"where id in ({keys_query}) "
+            "group by token "
+            ") delta "
+            "where d.rank = delta.token"
+        ).execute(
+            # a vanished token is held by no record, so that its rank may be taken again by a new token (ranks go
+            # on from the highest one left); a token coming back is ranked as a new one
+            f"delete from {self._table(DOC_FREQ_VIEW)} "
+            "where df = 0"
+        ).execute(
+            f"delete from {self._table(TOKENS_DOC_FREQ_VIEW)} "
+            f"where id in ({keys_query})"
+        ).execute(
+            f"delete from {self._table(PREFIXES_VIEW)} "
+            f"where id in ({keys_query})"
+        )
+
+    def drop(self):
+        self._scratch_clear()
+        self._con.execute(
+            f"drop table if exists {self._table(INDEX_META_VIEW)};"
+            f"drop table if exists {self._table(TOKENS_VIEW)};"
+            f"drop table if exists {self._table(DOC_FREQ_VIEW)};"
+            f"drop table if exists {self._table(TOKENS_DOC_FREQ_VIEW)};"
+            f"drop table if exists {self._table(PREFIXES_VIEW)};"
+        )
+
+    def _table(self, view: str):
+        return f"{self._name}_{view}"
+
+    def _scratch_table(self, view: str):
+        # probes and updates work in a namespace of this index object, open one per thread or service
+        return f"{self._ns}{self._name}_{view}"
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def min_threshold(self):
+        return self._t
+
+    def __init__(self, con: duckdb.DuckDBPyConnection, name: str):
+        self._con = con
+        self._name = name
+        self._ns = scratch_namespace()
+
+        meta = self._con.execute(
+            "select key_attr, join_attr, tokenizer, min_threshold "
+            f"from {self._table(INDEX_META_VIEW)}"
+        ).fetchall()
+        if not meta:
+            raise ValueError(f"index {name} is empty")
+        self._key_attr, self._join_attr, query, self._t = meta[0]
+        self._tokenizer = tokenizers.Tokenizer(query)
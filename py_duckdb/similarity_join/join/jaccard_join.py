@@ -1,10 +1,22 @@
+import json
+import math
+import multiprocessing
+import os
+import re
+import tempfile
+import time
 from abc import ABC, abstractmethod
+from concurrent.futures import ProcessPoolExecutor
 
 import duckdb
 
 from py_duckdb.similarity_join import tokenizers
+from py_duckdb.similarity_join.join import bounds, relations
 from py_duckdb.similarity_join.default_names import *
 
+# rough footprint of a prefix join row before aggregation: two ids, two positions and two lengths
+_PAIR_BYTES = 64
+
 
 def jaccard_join(
         con: duckdb.DuckDBPyConnection,
@@ -18,19 +30,292 @@ def jaccard_join(
         threshold: float,
         out_table: str,
         l_out_prefix: str = 'l_',
-        r_out_prefix: str = 'r_'
+        r_out_prefix: str = 'r_',
+        temporary: bool = True,
+        stats: dict = None,
+        engine: str = 'sql',
+        profile: bool = False,
+        scores: bool = False,
+        memory_limit: str = None,
+        temp_directory: str = None,
+        output: str = 'table',
+        partition_by: list[str] = None,
+        skew: bool = True,
+        dedup: bool = True,
+        prune: bool = True
 ):
-    if l_table:
-        if l_table == r_table or not r_table:
-            _JaccardSelfJoin(
-                con, l_table, l_key_attr, l_join_attr, tokenizer, threshold, out_table, l_out_prefix, r_out_prefix
-            ).do_join()
-        else:
-            _JaccardInnerJoin(
+    # engine 'sql' runs the whole pipeline in DuckDB, 'native' only tokenizes and orders there and runs candidate
+    # generation and verification in memory on the Arrow token lists (it needs numpy and pyarrow)
+    # scores adds the exact overlap and jaccard similarity of every pair to the output
+    # memory_limit (e.g. '8GB') bounds DuckDB for the duration of the join, spilling to temp_directory, and the sql
+    # engine verifies the candidates in bands of probe lengths sized to the budget
+    # l_table and r_table may also be Parquet paths or globs, Arrow tables, pandas DataFrames or relations, scanned
+    # in place; output 'arrow' returns the pairs as an Arrow table, 'parquet' writes them to the path out_table,
+    # partitioned by the partition_by columns if any
+    # skew=False runs the prefix join of the sql engine as one join, heavy tokens included (see skew_matches_query)
+    # dedup joins every distinct (normalized) join value once and expands the pairs of values to the pairs of their
+    # records' keys at the end, the records sharing a value of a self join pair up at similarity 1 (see collapse)
+    # prune drops the candidates of the sql engine that the bitmap filter rules out before verifying them (see prune)
+    _check_engine(engine, tokenizer)
+    with relations.inputs(con, l_table, r_table) as (l_table, r_table), \
+            relations.Output(con, output, out_table, partition_by) as out:
+        if l_table:
+            _make_join(
+                con, l_table, r_table, l_key_attr, r_key_attr, l_join_attr, r_join_attr, tokenizer, threshold,
+                out.table, l_out_prefix, r_out_prefix, temporary=temporary, stats=stats, profile=profile, scores=scores,
+                temporary_out=out.temporary, skew=skew, dedup=dedup, prune=prune
+            ).do_join(engine, memory_limit, temp_directory)
+    return out.result
+
+
+def jaccard_join_sweep(
+        con: duckdb.DuckDBPyConnection,
+        l_table: str,
+        r_table: str,
+        l_key_attr: str,
+        r_key_attr: str,
+        l_join_attr: str,
+        r_join_attr: str,
+        tokenizer: tokenizers.Tokenizer,
+        thresholds: list[float],
+        out_table: str,
+        l_out_prefix: str = 'l_',
+        r_out_prefix: str = 'r_',
+        temporary: bool = True,
+        stats: dict = None,
+        engine: str = 'sql',
+        profile: bool = False,
+        output: str = 'table',
+        partition_by: list[str] = None
+):
+    # a single join at the lowest threshold serves all of them: its candidate set is a superset of theirs, and the
+    # output keeps the exact overlap and jaccard of every pair, so that the result at threshold t is the rows with
+    # jaccard >= t; evaluate(..., thresholds=thresholds) scores them all in one scan. That filter is the join at t
+    # exactly, as the joins compare with the threshold exactly (see bounds) and jaccard is a correctly rounded
+    # double: a pair at exactly t has the same double as t
+    if not thresholds:
+        raise ValueError("no thresholds to sweep")
+    _check_engine(engine, tokenizer)
+    with relations.inputs(con, l_table, r_table) as (l_table, r_table), \
+            relations.Output(con, output, out_table, partition_by) as out:
+        if l_table:
+            _make_join(
+                con, l_table, r_table, l_key_attr, r_key_attr, l_join_attr, r_join_attr, tokenizer, min(thresholds),
+                out.table, l_out_prefix, r_out_prefix, temporary=temporary, stats=stats, profile=profile, scores=True,
+                temporary_out=out.temporary
+            ).do_join(engine)
+    return out.result
+
+
+def jaccard_join_topk(
+        con: duckdb.DuckDBPyConnection,
+        l_table: str,
+        r_table: str,
+        l_key_attr: str,
+        r_key_attr: str,
+        l_join_attr: str,
+        r_join_attr: str,
+        tokenizer: tokenizers.Tokenizer,
+        k: int,
+        out_table: str,
+        l_out_prefix: str = 'l_',
+        r_out_prefix: str = 'r_',
+        per_record: bool = False,
+        min_threshold: float = 0.1,
+        temporary: bool = True,
+        stats: dict = None,
+        profile: bool = False,
+        output: str = 'table',
+        partition_by: list[str] = None
+):
+    # the k most similar pairs, or with per_record the k most similar partners of every left record (of every
+    # record in a self join), with their overlap and jaccard; pairs below min_threshold are never considered
+    if k < 1:
+        raise ValueError(f"k must be positive, got {k}")
+    with relations.inputs(con, l_table, r_table) as (l_table, r_table), \
+            relations.Output(con, output, out_table, partition_by) as out:
+        if l_table:
+            _make_join(
+                con, l_table, r_table, l_key_attr, r_key_attr, l_join_attr, r_join_attr, tokenizer, min_threshold,
+                out.table, l_out_prefix, r_out_prefix, temporary=temporary, stats=stats, profile=profile, scores=True,
+                temporary_out=out.temporary
+            ).do_join_topk(k, per_record, min_threshold)
+    return out.result
+
+
+def jaccard_join_approximate(
+        con: duckdb.DuckDBPyConnection,
+        l_table: str,
+        r_table: str,
+        l_key_attr: str,
+        r_key_attr: str,
+        l_join_attr: str,
+        r_join_attr: str,
+        tokenizer: tokenizers.Tokenizer,
+        threshold: float,
+        out_table: str,
+        l_out_prefix: str = 'l_',
+        r_out_prefix: str = 'r_',
+        num_perm: int = 128,
+        recall: float = 0.95,
+        verify: bool = True,
+        seed: int = 0,
+        temporary: bool = True,
+        stats: dict = None,
+        profile: bool = False,
+        scores: bool = False,
+        output: str = 'table',
+        partition_by: list[str] = None,
+        dedup: bool = True,
+        prune: bool = True
+):
+    # MinHash LSH instead of prefix filtering, for low thresholds where the prefixes are most of the tokens: the
+    # candidates are the pairs that share a bucket in one of the bands of their num_perm minhashes, the bands
+    # chosen so that a pair at the threshold is a candidate with probability at least recall (pairs above it more
+    # likely still). verify checks the candidates against the token sets, so that every pair is a true match and
+    # only recall is lost; without it the pairs are those of estimated similarity at least threshold, with
+    # estimated scores. evaluate() against an exact join measures the loss
+    if not tokenizer.return_set:
+        raise ValueError("minhashes need a tokenizer with return_set=True")
+    if not 0 < recall < 1:
+        raise ValueError(f"recall must be between 0 and 1, got {recall}")
+    with relations.inputs(con, l_table, r_table) as (l_table, r_table), \
+            relations.Output(con, output, out_table, partition_by) as out:
+        if l_table:
+            _make_join(
+                con, l_table, r_table, l_key_attr, r_key_attr, l_join_attr, r_join_attr, tokenizer, threshold,
+                out.table, l_out_prefix, r_out_prefix, temporary=temporary, stats=stats, profile=profile, scores=scores,
+                temporary_out=out.temporary, dedup=dedup, prune=prune
+            ).do_join_approximate(num_perm, recall, verify, seed)
+    return out.result
+
+
+def _lsh_bands(threshold: float, num_perm: int, recall: float):
+    # a pair of similarity s shares a bucket of some band of r minhashes with probability 1 - (1 - s^r)^b: the most
+    # rows per band (the fewest dissimilar candidates) that still find a pair at the threshold with the given recall
+    for rows in range(num_perm, 0, -1):
+        bands = num_perm // rows
+        if 1 - (1 - threshold ** rows) ** bands >= recall:
+            return bands, rows
+    return num_perm, 1
+
+
+def _topk_thresholds(min_threshold: float):
+    # from exact duplicates down to min_threshold, the early joins at high thresholds are cheap
+    return [t / 10 for t in range(10, 0, -1) if t / 10 > min_threshold] + [min_threshold]
+
+
+def _check_engine(engine: str, tokenizer: tokenizers.Tokenizer):
+    if engine not in ('sql', 'native'):
+        raise ValueError(f"unknown engine {engine}")
+    # the native engine intersects the token lists as sets, a token twice in a record would miscount its overlap
+    if engine == 'native' and not tokenizer.distinct:
+        raise ValueError("the native engine needs a tokenizer of distinct tokens (return_set=True)")
+
+
+def jaccard_join_iter(
+        con: duckdb.DuckDBPyConnection,
+        l_table: str,
+        r_table: str,
+        l_key_attr: str,
+        r_key_attr: str,
+        l_join_attr: str,
+        r_join_attr: str,
+        tokenizer: tokenizers.Tokenizer,
+        threshold: float,
+        l_out_prefix: str = 'l_',
+        r_out_prefix: str = 'r_',
+        partition_size: int = 100_000,
+        rows_per_batch: int = 1_000_000,
+        temporary: bool = True,
+        stats: dict = None,
+        profile: bool = False,
+        scores: bool = False
+):
+    # yields the matches as Arrow record batches, one length range of partition_size probe records at a time
+    with relations.inputs(con, l_table, r_table) as (l_table, r_table):
+        if l_table:
+            yield from _make_join(
+                con, l_table, r_table, l_key_attr, r_key_attr, l_join_attr, r_join_attr, tokenizer, threshold, None,
+                l_out_prefix, r_out_prefix, temporary=temporary, stats=stats, profile=profile, scores=scores
+            ).do_join_iter(partition_size, rows_per_batch)
+
+
+def jaccard_join_parallel(
+        con: duckdb.DuckDBPyConnection,
+        l_table: str,
+        r_table: str,
+        l_key_attr: str,
+        r_key_attr: str,
+        l_join_attr: str,
+        r_join_attr: str,
+        tokenizer: tokenizers.Tokenizer,
+        threshold: float,
+        out_table: str,
+        l_out_prefix: str = 'l_',
+        r_out_prefix: str = 'r_',
+        workers: int = None,
+        threads_per_worker: int = 1,
+        snapshot_dir: str = None,
+        temporary: bool = True,
+        stats: dict = None,
+        profile: bool = False,
+        scores: bool = False,
+        output: str = 'table',
+        partition_by: list[str] = None
+):
+    workers = workers or os.cpu_count()
+    with relations.inputs(con, l_table, r_table) as (l_table, r_table), \
+            relations.Output(con, output, out_table, partition_by) as out:
+        if l_table:
+            _make_join(
                 con, l_table, r_table, l_key_attr, r_key_attr, l_join_attr, r_join_attr, tokenizer, threshold,
-                out_table, l_out_prefix, r_out_prefix
-            ).do_join()
-    return con
+                out.table, l_out_prefix, r_out_prefix, temporary=temporary, stats=stats, profile=profile, scores=scores,
+                temporary_out=out.temporary
+            ).do_join_parallel(workers, threads_per_worker, snapshot_dir)
+    return out.result
+
+
+def _join_shard(
+        snapshot: str,
+        tables: list[str],
+        threads: int,
+        candset: str,
+        candidates_query: str,
+        matches_query: str,
+        out: str
+):
+    con = duckdb.connect()
+    try:
+        con.execute(f"set threads = {threads}")
+        for table in tables:
+            con.execute(f"create view {table} as select * from read_parquet('{os.path.join(snapshot, table)}.parquet')")
+        con.execute(
+            f"create table {candset} as " + candidates_query
+        ).execute(
+            f"copy ({matches_query}) to '{out}' (format parquet)"
+        )
+    finally:
+        con.close()
+    return out
+
+
+def _parse_bytes(size: str):
+    # DuckDB's memory sizes: KB, MB, GB and TB are powers of 1000, KiB, MiB, GiB and TiB powers of 1024
+    match = re.fullmatch(r"\s*([0-9.]+)\s*([kmgt]?)(i?)b?\s*", str(size).lower())
+    if not match:
+        raise ValueError(f"cannot parse memory size {size}")
+    number, unit, binary = match.groups()
+    return int(float(number) * (1024 if binary else 1000) ** ' kmgt'.index(unit or ' '))
+
+
+def _written_bytes():
+    # bytes handed to write() by the whole process (Linux only): WAL, checkpoints and spilling alike
+    try:
+        with open('/proc/self/io') as io:
+            return next(int(line.split()[1]) for line in io if line.startswith('wchar'))
+    except (OSError, StopIteration):
+        return None
 
 
 def jaccard_join_brute_force(
@@ -45,39 +330,749 @@ def jaccard_join_brute_force(
         threshold: float,
         out_table: str,
         l_out_prefix: str = 'l_',
-        r_out_prefix: str = 'r_'
+        r_out_prefix: str = 'r_',
+        temporary: bool = True,
+        stats: dict = None,
+        profile: bool = False,
+        scores: bool = False,
+        output: str = 'table',
+        partition_by: list[str] = None
 ):
-    if l_table:
-        if l_table == r_table or not r_table:
-            _JaccardSelfJoin(
-                con, l_table, l_key_attr, l_join_attr, tokenizer, threshold, out_table, l_out_prefix, r_out_prefix
-            ).do_brute_force_join()
-        else:
-            _JaccardInnerJoin(
+    with relations.inputs(con, l_table, r_table) as (l_table, r_table), \
+            relations.Output(con, output, out_table, partition_by) as out:
+        if l_table:
+            _make_join(
                 con, l_table, r_table, l_key_attr, r_key_attr, l_join_attr, r_join_attr, tokenizer, threshold,
-                out_table, l_out_prefix, r_out_prefix
+                out.table, l_out_prefix, r_out_prefix, temporary=temporary, stats=stats, profile=profile, scores=scores,
+                temporary_out=out.temporary
             ).do_brute_force_join()
-    return con
+    return out.result
+
+
+def _make_join(
+        con: duckdb.DuckDBPyConnection,
+        l_table: str,
+        r_table: str,
+        l_key_attr: str,
+        r_key_attr: str,
+        l_join_attr: str,
+        r_join_attr: str,
+        tokenizer: tokenizers.Tokenizer,
+        threshold: float,
+        out_table: str,
+        l_out_prefix: str,
+        r_out_prefix: str,
+        **options
+):
+    # a self join when both sides are the same table or there is no right one, an inner join otherwise; options are
+    # the keyword arguments of both (temporary, stats, scores, ...)
+    if l_table == r_table or not r_table:
+        return _JaccardSelfJoin(
+            con, l_table, l_key_attr, l_join_attr, tokenizer, threshold, out_table, l_out_prefix, r_out_prefix,
+            **options
+        )
+    return _JaccardInnerJoin(
+        con, l_table, r_table, l_key_attr, r_key_attr, l_join_attr, r_join_attr, tokenizer, threshold, out_table,
+        l_out_prefix, r_out_prefix, **options
+    )
 
 
 class _JaccardTemplateJoin(ABC):
 
-    def do_join(self):
+    def __init__(
+            self,
+            con: duckdb.DuckDBPyConnection,
+            tokenizer: tokenizers.Tokenizer,
+            threshold: float,
+            out_table: str,
+            temporary: bool,
+            stats: dict,
+            profile: bool,
+            scores: bool,
+            temporary_out: bool,
+            skew: bool,
+            dedup: bool,
+            prune: bool
+    ):
+        self._con = con
+        self._ns = scratch_namespace()
+        # temporary intermediates stay in memory (spilling only when needed) instead of going through the WAL
+        self._create_table = "create temp table" if temporary else "create table"
+        self._stats = stats
+        self._profile = profile
+        self._scores = scores
+        self._stage = None
+        self._pairs = 0
+        self._tokenizer = tokenizer
+        self._t = threshold
+        self._out_table = out_table
+        # the output is a temp table only when it is staged for an arrow or parquet output
+        self._create_out_table = "create temp table" if temporary_out else "create table"
+
+        self._length_range = None
+        self._settled = None
+        self._skew = skew
+        self._heavy_tids = None
+        self._dedup = dedup
+        self._duplicates = []
+        self._expand_into = None
+        # the overlap bound of the bitmap filter holds for sets of distinct tokens only
+        self._prune = prune and tokenizer.distinct
+        self._signature_bits = None
+        self._signatures = []
+        self._minhash_perms = 0
+        self._minhashes = []
+
+    def do_join(self, engine: str = 'sql', memory_limit: str = None, temp_directory: str = None):
+        written = _written_bytes()
+        self.start_stats()
+        settings = self.apply_settings(memory_limit, temp_directory)
         try:
-            self.tokenize()
-            self.document_frequency()
-            self.prefixes()
+            self.stage(self.tokenize)
+            self.stage(self.document_frequency)
+            if engine == 'native':
+                self.stage(self.native_matches)
+            elif memory_limit:
+                self.stage(self.prefixes)
+                self.stage(self.banded_matches, _parse_bytes(memory_limit))
+            else:
+                self.stage(self.prefixes)
+                self.stage(self.candidates)
+                if self._prune:
+                    self.stage(self.prune)
+                self.stage(self.matches)
+            if self._expand_into:
+                self.stage(self.expand)
+            self.report_pruning()
+        finally:
+            self.clear()
+            self.restore_settings(settings)
+            self.stop_stats(written)
+
+    def banded_matches(self, memory_budget: int):
+        # the prefix join of each band of probe lengths is planned to a quarter of the budget, leaving the rest to
+        # its aggregation and to verification; a band that does not fit anyway (a single length over the budget)
+        # spills to the temp directory instead of failing
+        bands = self.length_partitions(
+            max(1, memory_budget // 4 // _PAIR_BYTES), self.probe_cost_query()
+        ) or [(1, 0)]
+        self._con.execute(f"drop table if exists {self._out_table}")
+        for i, self._length_range in enumerate(bands):
             self.candidates()
-            self.matches()
+            if self._prune:
+                self.prune()
+            self._con.execute(
+                (f"{self._create_out_table} {self._out_table} as " if i == 0 else f"insert into {self._out_table} ")
+                + self.matches_query()
+            ).execute(
+                f"drop table if exists {self._ns}{CANDIDATE_SET_VIEW}"
+            )
+        self._length_range = None
+        self.observe('matches', self._out_table, profiled=False)
+        if self._stats is not None:
+            self._stats['bands'] = len(bands)
+
+    def apply_settings(self, memory_limit: str, temp_directory: str):
+        # memory_limit is a setting of the whole database, it is restored after the join; temp_directory is not, as
+        # DuckDB cannot switch it once something spilled there
+        if not memory_limit and not temp_directory:
+            return None
+        limit, preserve_insertion_order, previous_directory = self._con.execute(
+            "select current_setting('memory_limit'), current_setting('preserve_insertion_order'), "
+            "current_setting('temp_directory')"
+        ).fetchall()[0]
+        restore_limit = None
+        if memory_limit:
+            # the limit is only shown, cut down to a tenth of its unit (e.g. 4.6 GiB), setting that back would lower
+            # it: it is set back to the middle of what it shows instead, so that it shows the same and stays within
+            # 0.05 of its unit. reset memory_limit is no way back to the default, it only changes the shown setting
+            # while the buffer manager keeps the limit of the join
+            value, unit = limit.split()
+            restore_limit = f"set memory_limit = '{float(value) + 0.05} {unit}'"
+            self._con.execute(f"set memory_limit = '{memory_limit}'")
+        previous = (restore_limit, preserve_insertion_order, previous_directory)
+        if temp_directory and temp_directory != previous_directory:
+            try:
+                self._con.execute(f"set temp_directory = '{temp_directory}'")
+            except duckdb.NotImplementedException:
+                self.restore_settings(previous)
+                raise ValueError(
+                    f"the temporary directory of this connection is already {previous_directory}, "
+                    f"set temp_directory when connecting to spill into {temp_directory}"
+                )
+        # no intermediate needs its insertion order, dropping it lets the large ones stream and spill
+        self._con.execute("set preserve_insertion_order = false")
+        return previous
+
+    def restore_settings(self, previous):
+        if previous is None:
+            return
+        restore_limit, preserve_insertion_order, _ = previous
+        if restore_limit:
+            self._con.execute(restore_limit)
+        self._con.execute(f"set preserve_insertion_order = {preserve_insertion_order}")
+
+    def do_join_iter(self, partition_size: int, rows_per_batch: int):
+        written = _written_bytes()
+        self.start_stats()
+        try:
+            self.stage(self.tokenize)
+            self.stage(self.document_frequency)
+            self.stage(self.prefixes)
+            for self._length_range in self.length_partitions(partition_size):
+                self.stage(self.candidates)
+                if self._prune:
+                    self.stage(self.prune)
+                # each partition is fetched whole, so that the connection is free again when the batches are consumed
+                batches = self.stage(self.partition_matches, rows_per_batch)
+                self._con.execute(f"drop table if exists {self._ns}{CANDIDATE_SET_VIEW}")
+                yield from batches
+            self.report_pruning()
+        finally:
+            self.clear()
+            self.stop_stats(written)
+
+    def partition_matches(self, rows_per_batch: int):
+        batches = self._con.execute(self.matches_query()).to_arrow_reader(rows_per_batch).read_all().to_batches()
+        if self._stats is not None:
+            self.profile_last_statement()
+            rows = self._stats['rows']
+            rows['matches'] = rows.get('matches', 0) + sum(batch.num_rows for batch in batches)
+        return batches
+
+    def do_join_parallel(self, workers: int, threads_per_worker: int, snapshot_dir: str):
+        written = _written_bytes()
+        self.start_stats()
+        try:
+            self.stage(self.tokenize)
+            self.stage(self.document_frequency)
+            self.stage(self.prefixes)
+            with tempfile.TemporaryDirectory(dir=snapshot_dir) as snapshot:
+                # the workers read the token tables from a Parquet snapshot, each on its own in-memory database
+                for table in self.snapshot_tables():
+                    self._con.execute(f"copy {table} to '{os.path.join(snapshot, table)}.parquet' (format parquet)")
+
+                # a few shards per worker smooth out the uneven cost of the length ranges
+                records = self._con.execute(
+                    f"select coalesce(sum(c), 0) from ({self.probe_lengths_query()}) as lengths(len, c)"
+                ).fetchall()[0][0]
+                shards = self.length_partitions(max(1, math.ceil(records / (workers * 4)))) or [(1, 0)]
+
+                queries = []
+                for self._length_range in shards:
+                    queries.append((self.candidates_query(), self.matches_query()))
+                self._length_range = None
+
+                outs = [os.path.join(snapshot, f"shard_{i}.parquet") for i in range(len(shards))]
+                self.stage(self.shard_matches, workers, threads_per_worker, snapshot, queries, outs)
+        finally:
+            self.clear()
+            self.stop_stats(written)
+
+    def shard_matches(self, workers: int, threads_per_worker: int, snapshot: str, queries: list, outs: list[str]):
+        # the candidates and the matches of a shard are computed together in a worker, the stage times both
+        with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+            list(pool.map(
+                _join_shard,
+                [snapshot] * len(outs), [self.snapshot_tables()] * len(outs),
+                [threads_per_worker] * len(outs), [f"{self._ns}{CANDIDATE_SET_VIEW}"] * len(outs),
+                [q[0] for q in queries], [q[1] for q in queries], outs
+            ))
+
+        self._con.execute(
+            f"drop table if exists {self._out_table}"
+        ).execute(
+            f"{self._create_out_table} {self._out_table} as "
+            f"select * from read_parquet([{', '.join(repr(out) for out in outs)}])"
+        )
+        self.observe('matches', self._out_table)
+
+    def do_join_topk(self, k: int, per_record: bool, min_threshold: float):
+        # the threshold starts at 1 and goes down until the answer is certain: once k pairs reach threshold t, the
+        # k-th best score is at least t and no pair below t can displace them, and the same holds for the partners
+        # of each record; the tokens and their order do not depend on the threshold and are computed only once
+        written = _written_bytes()
+        self.start_stats()
+        try:
+            self.stage(self.tokenize)
+            self.stage(self.document_frequency)
+            thresholds = _topk_thresholds(min_threshold)
+            while thresholds:
+                self._t = thresholds.pop(0)
+                self.stage(self.prefixes)
+                self.stage(self.candidates)
+                if self._prune:
+                    self.stage(self.prune)
+                self.stage(self.topk_matches)
+                settled = self.topk_settled(k, per_record)
+                if settled >= 1:
+                    break
+                if per_record and settled < 0.5:
+                    # most records are short of k partners: one join at the lowest threshold is cheaper than
+                    # every step down to it
+                    thresholds = thresholds[-1:]
+            self.stage(self.topk_results, k, per_record)
+            if self._stats is not None:
+                self._stats['topk_threshold'] = self._t
+        finally:
+            self.clear()
+            self.stop_stats(written)
+
+    def do_join_approximate(self, num_perm: int, recall: float, verify: bool, seed: int):
+        written = _written_bytes()
+        self.start_stats()
+        try:
+            self.stage(self.tokenize)
+            self.stage(self.document_frequency)
+            self.stage(self.lsh_candidates, num_perm, recall, seed)
+            # the bitmap filter is exact, it spares the estimates as much as the verification
+            if self._prune:
+                self.stage(self.prune)
+            if verify:
+                self.stage(self.matches)
+            else:
+                self.stage(self.estimated_matches)
+            if self._expand_into:
+                self.stage(self.expand)
+            self.report_pruning()
         finally:
             self.clear()
+            self.stop_stats(written)
+
+    def lsh_candidates(self, num_perm: int, recall: float, seed: int):
+        # the candidates come in the shape of the prefix join's, with no prefix overlap, so that matches() merges the
+        # token sets from their first position; the length filter holds as for any pair
+        bands, rows = _lsh_bands(self._t, num_perm, recall)
+        self._minhash_perms = num_perm
+        (l_side, l_tokens), (r_side, r_tokens) = self.candidate_sides()
+        l_buckets, r_buckets = self.buckets(l_tokens, bands, rows, seed), self.buckets(r_tokens, bands, rows, seed)
+        self._con.execute(
+            f"drop table if exists {self._ns}{CANDIDATE_SET_VIEW}"
+        ).execute(
+            f"{self._create_table} {self._ns}{CANDIDATE_SET_VIEW} as "
+            f"select distinct L.id as {l_side}id, R.id as {r_side}id, "
+            f"0 as {l_side}maxPos, 0 as {r_side}maxPos, 1 as pfxOverlap "
+            f"from {l_buckets} L, {r_buckets} R "
+            "where L.band = R.band "
+            "and L.bucket = R.bucket "
+            # a self join pairs every record with the later ones only
+            + ("and L.id < R.id " if l_tokens == r_tokens else "") +
+            f"and {bounds.length_at_least('least(L.len, R.len)', 'greatest(L.len, R.len)', self._t)}"
+        )
+        self.observe('candidates', f"{self._ns}{CANDIDATE_SET_VIEW}")
+        if self._stats is not None:
+            self._stats['lsh'] = {
+                'num_perm': num_perm,
+                'bands': bands,
+                'rows': rows,
+                'recall_at_threshold': 1 - (1 - self._t ** rows) ** bands
+            }
+
+    def buckets(self, tokens: str, bands: int, rows: int, seed: int):
+        # minhash i of a record is the least hash(token, i, seed) of its tokens, the bucket of a band hashes its rows
+        minhashes = f"{tokens}_{MINHASHES_VIEW}"
+        buckets = f"{tokens}_{BUCKETS_VIEW}"
+        if minhashes in self._minhashes:
+            return buckets
+        self._con.execute(
+            f"drop table if exists {minhashes}"
+        ).execute(
+            f"{self._create_table} {minhashes} as "
+            "select id, len, "
+            f"list_transform(range({self._minhash_perms}), "
+            f"i -> list_min(list_transform(tks, x -> hash(x, i, {seed})))) as sig "
+            f"from (select id, any_value(len) as len, list(token) as tks from {tokens} group by id)"
+        ).execute(
+            f"drop table if exists {buckets}"
+        ).execute(
+            f"{self._create_table} {buckets} as "
+            f"select id, len, unnest(range({bands})) as band, "
+            f"unnest(list_transform(range({bands}), b -> hash(sig[b * {rows} + 1:(b + 1) * {rows}]))) as bucket "
+            f"from {minhashes}"
+        )
+        self.observe('buckets', buckets)
+        self._minhashes.append(minhashes)
+        return buckets
+
+    def estimated_matches(self):
+        # the share of equal minhashes estimates the similarity of a candidate
+        (l_side, l_tokens), (r_side, r_tokens) = self.candidate_sides()
+        perms = self._minhash_perms
+        estimate = f"(len(list_filter(range(1, {perms} + 1), i -> L.sig[i] = R.sig[i])) / {perms})"
+        self._con.execute(
+            f"drop table if exists {self._out_table}"
+        ).execute(
+            f"{self._create_out_table} {self._out_table} as " + self.estimated_matches_query(
+                f"(select c.{l_side}id, c.{r_side}id, L.len as {l_side}len, R.len as {r_side}len, "
+                f"{estimate} as estimate "
+                f"from {self._ns}{CANDIDATE_SET_VIEW} c, {l_tokens}_{MINHASHES_VIEW} L, {r_tokens}_{MINHASHES_VIEW} R "
+                f"where c.{l_side}id = L.id "
+                f"and c.{r_side}id = R.id)"
+            )
+        )
+        self.observe('matches', self._out_table)
+
+    def topk_matches(self):
+        # the pairs of the settled records were all found at a higher threshold, the new ones are accumulated
+        columns = ", ".join(self.out_columns()) + ", overlap, jaccard"
+        if self._settled:
+            self._con.execute(
+                f"insert into {self._ns}topk "
+                f"select {columns} from ({self.matches_query()}) "
+                f"except select {columns} from {self._ns}topk"
+            )
+        else:
+            self._con.execute(
+                f"drop table if exists {self._ns}topk"
+            ).execute(
+                f"{self._create_table} {self._ns}topk as select {columns} from ({self.matches_query()})"
+            )
+        self.observe('matches', f"{self._ns}topk")
+        self._con.execute(f"drop table if exists {self._ns}{CANDIDATE_SET_VIEW}")
+
+    def topk_settled(self, k: int, per_record: bool):
+        # the settled fraction of the answer: of the k pairs, or of the left records
+        l_col, r_col = self.out_columns()
+        if not per_record:
+            return min(1.0, self._con.execute(f"select count(*) from {self._ns}topk").fetchall()[0][0] / k)
+
+        # a record with k partners at this threshold has its final top k, the lower thresholds only look for
+        # partners of the others
+        self._con.execute(
+            f"drop table if exists {self._ns}settled"
+        ).execute(
+            f"{self._create_table} {self._ns}settled as "
+            "select id "
+            f"from ({self.topk_partners_query(l_col, r_col)}) "
+            "group by id "
+            f"having count(*) >= {k}"
+        )
+        self._settled = f"{self._ns}settled"
+        settled = self._con.execute(f"select count(*) from {self._settled}").fetchall()[0][0]
+        return settled / self.topk_records() if self.topk_records() else 1.0
+
+    def topk_results(self, k: int, per_record: bool):
+        l_col, r_col = self.out_columns()
+        if per_record:
+            query = (
+                f"select id as {l_col}, partner as {r_col}, overlap, jaccard "
+                f"from ({self.topk_partners_query(l_col, r_col)}) "
+                f"qualify row_number() over (partition by id order by jaccard desc, partner) <= {k}"
+            )
+        else:
+            query = (
+                f"select {l_col}, {r_col}, overlap, jaccard "
+                f"from {self._ns}topk "
+                f"qualify row_number() over (order by jaccard desc, {l_col}, {r_col}) <= {k}"
+            )
+        self._con.execute(
+            f"drop table if exists {self._out_table}"
+        ).execute(
+            f"{self._create_out_table} {self._out_table} as " + query
+        )
+
+    def settled_filter(self, *aliases: str):
+        # in a per-record top-k join only the pairs of records still short of k partners are worth verifying; the
+        # aliases are those of the ranked records, both sides of a self join but the left one only of an inner join
+        if not self._settled:
+            return ""
+        return "AND (" + " OR ".join(f"{alias}.id NOT IN (SELECT id FROM {self._settled})" for alias in aliases) + ") "
+
+    def length_partitions(self, partition_size: int, lengths_query: str = None):
+        # greedily cut the probe lengths into ranges of about partition_size records (or of the cost given by
+        # lengths_query for each length), the length filter makes each range independent of the others
+        ranges = []
+        lo, size = None, 0
+        for length, count in self._con.execute(lengths_query or self.probe_lengths_query()).fetchall():
+            if lo is None:
+                lo = length
+            size += count
+            if size >= partition_size:
+                ranges.append((lo, length))
+                lo, size = None, 0
+        if lo is not None:
+            ranges.append((lo, length))
+        return ranges
+
+    def length_range_filter(self, alias: str):
+        if self._length_range is None:
+            return ""
+        return f"AND {alias}.len BETWEEN {self._length_range[0]} AND {self._length_range[1]} "
+
+    def prune(self):
+        # bitmap filter: every token sets bit token % bits of the signature of its record. A bit set in one of the
+        # two signatures only stands for at least one token of that record alone, so that the overlap of a pair is at
+        # most (L.len + R.len - bit_count(L xor R)) / 2, and the candidates it leaves below the overlap bound are
+        # dropped before the suffixes are merged
+        (l_side, l_tokens), (r_side, r_tokens) = self.candidate_sides()
+        if self._signature_bits is None:
+            # about four bits per token of a typical record, so that few of its tokens share a bit
+            typical = self._con.execute(
+                f"select avg(len) from (select len from {l_tokens} union all select len from {r_tokens})"
+            ).fetchall()[0][0] or 1
+            self._signature_bits = min(1024, max(64, 2 ** math.ceil(math.log2(4 * typical))))
+        candset = f"{self._ns}{CANDIDATE_SET_VIEW}"
+        self._con.execute(
+            f"drop table if exists {self._ns}unpruned"
+        ).execute(
+            f"alter table {candset} rename to {self._ns}unpruned"
+        ).execute(
+            f"{self._create_table} {candset} as "
+            "select c.* "
+            f"from {self._ns}unpruned c, {self.signatures(l_tokens)} L, {self.signatures(r_tokens)} R "
+            f"where c.{l_side}id = L.id "
+            f"and c.{r_side}id = R.id "
+            # both sides doubled, the bound is a half
+            "and " + bounds.overlap_at_least(
+                "L.len + R.len - bit_count(xor(L.sig, R.sig))", "2 * L.len", "2 * R.len", self._t
+            )
+        )
+        self.observe('verified_candidates', candset)
+        self._con.execute(f"drop table if exists {self._ns}unpruned")
+
+    def signatures(self, tokens: str):
+        # built once per join, they do not depend on the threshold
+        table = f"{tokens}_{SIGNATURES_VIEW}"
+        if table not in self._signatures:
+            self._con.execute(
+                f"drop table if exists {table}"
+            ).execute(
+                f"{self._create_table} {table} as "
+                "select id, any_value(len) as len, "
+                f"bitstring_agg((token % {self._signature_bits})::integer, 0, {self._signature_bits - 1}) as sig "
+                f"from {tokens} "
+                "group by id"
+            )
+            self._signatures.append(table)
+        return table
+
+    def collapse(self, table: str, key_attr: str, join_attr: str, duplicates: str):
+        # records with equal normalized join values have the same tokens: only the record of least key of each value
+        # is tokenized and joined, duplicates keeps the keys of the values shared by several records for expand().
+        # Returns the relation to tokenize, a query rather than a scratch table so that a token cache recognizes it
+        # from one join to the next. Bags of tokens are left alone: their overlaps count the products of repeated tokens
+        if not self._dedup or not self._tokenizer.return_set:
+            return table
+        value = self._tokenizer.normalize(join_attr)
+        self._con.execute(
+            f"drop table if exists {duplicates}"
+        ).execute(
+            f"{self._create_table} {duplicates} as "
+            f"select min({key_attr}) as rep, list({key_attr}) as keys "
+            f"from {table} "
+            f"group by {value} "
+            "having count(*) > 1"
+        )
+        folded = self._con.execute(f"select coalesce(sum(len(keys) - 1), 0) from {duplicates}").fetchall()[0][0]
+        if self._stats is not None:
+            self._stats['rows']['duplicates'] = self._stats['rows'].get('duplicates', 0) + folded
+        if not folded:
+            self._con.execute(f"drop table if exists {duplicates}")
+            return table
+
+        self._duplicates.append(duplicates)
+        if self._expand_into is None:
+            # the pipeline writes the pairs of values to a scratch table, expand() writes the output
+            self._expand_into = (self._out_table, self._create_out_table)
+            self._out_table, self._create_out_table = f"{self._ns}value_pairs", self._create_table
+        return f"(select min({key_attr}) as {key_attr}, {value} as {join_attr} from {table} group by {value})"
+
+    def expand(self):
+        value_pairs = self._out_table
+        self._out_table, self._create_out_table = self._expand_into
+        self._expand_into = None
+        if self._stats is not None:
+            self._stats['rows']['value_matches'] = self._stats['rows'].pop('matches', 0)
+        self._con.execute(
+            f"drop table if exists {self._out_table}"
+        ).execute(
+            f"{self._create_out_table} {self._out_table} as " + self.expand_query(value_pairs)
+        )
+        self.observe('matches', self._out_table)
+        self._con.execute(f"drop table if exists {value_pairs}")
+
+    def key_pairs_query(self, value_pairs: str, l_duplicates: str, r_duplicates: str):
+        # every pair of values stands for the pairs of the keys of their records; a value of a single record is
+        # its own key
+        l_col, r_col = self.out_columns()
+        select, joins = [], ""
+        for col, duplicates, alias in ((l_col, l_duplicates, 'L'), (r_col, r_duplicates, 'R')):
+            if duplicates in self._duplicates:
+                select.append(f"coalesce({alias}.member, p.{col}) as {col}")
+                joins += (
+                    f"left join (select rep, unnest(keys) as member from {duplicates}) {alias} "
+                    f"on p.{col} = {alias}.rep "
+                )
+            else:
+                select.append(f"p.{col}")
+        return (
+            f"select {', '.join(select)}" + (", p.overlap, p.jaccard " if self._scores else " ")
+            + f"from {value_pairs} p " + joins
+        )
+
+    def heavy_tokens(self, token_pairs: str, records: str):
+        # a token is heavy when its prefix entries pair up into more rows than there are records, token_pairs gives
+        # these rows for every token. Ids follow the global (df, token) order, so the heavy tokens come after the
+        # light ones in every record; the plan splits the ids at the first heavy one, up to the last id both prefix
+        # sides have (none past it can match)
+        self._heavy_tids = None
+        if not self._skew or self._t <= 0:
+            return
+        first, last, heavy = self._con.execute(
+            "with first as ("
+            f"select min(token) as tid from {token_pairs} where pairs > {records}"
+            ") "
+            "select any_value(first.tid), max(token) filter (where pairs > 0), "
+            "count(*) filter (where token >= first.tid and pairs > 0) "
+            f"from {token_pairs}, first"
+        ).fetchall()[0]
+        if first is not None:
+            self._heavy_tids = (first, last)
+        if self._stats is not None:
+            self._stats['rows']['heavy_tokens'] = heavy
+
+    def token_pairs_query(self, index_entries: str, probe_entries: str):
+        return (
+            "(select token, sum(i) * sum(p) as pairs from ("
+            f"select token, count(*) as i, 0 as p from {index_entries} group by token "
+            "union all "
+            f"select token, 0 as i, count(*) as p from {probe_entries} group by token"
+            ") group by token)"
+        )
+
+    def skew_matches_query(self, index_entries: str, probe_entries: str, aliases: tuple, longest_partner: str):
+        # the matches of the prefix join. The light tokens are joined on the token, the heavy ones on the token and
+        # the length of the index record, every probe entry repeated for each length the length and positional
+        # filters leave it: the join hands the filters the pairs of compatible lengths only, not the cross product
+        # of the long postings of a heavy token. The filters still apply, so the matches are the same
+        if self._heavy_tids is None:
+            return self.prefix_matches_query(index_entries, probe_entries, "")
+        index, probe = aliases
+        return (
+            self.prefix_matches_query(index_entries, probe_entries, f"AND {index}.token < {self._heavy_tids[0]} ")
+            + "UNION ALL "
+            + self.prefix_matches_query(
+                index_entries, self.bucketed_entries(probe_entries, longest_partner),
+                f"AND {index}.token BETWEEN {self._heavy_tids[0]} AND {self._heavy_tids[1]} "
+                f"AND {index}.len = {probe}.partner_len "
+            )
+        )
+
+    def bucketed_entries(self, probe_entries: str, longest_partner: str):
+        # the partner lengths of a probe entry run from len * t to longest_partner and to the longest the positional
+        # filter allows, the latter widened by a rounding slack as the division is a double; entries past the probing
+        # prefix get none
+        t = bounds.threshold_literal(self._t)
+        return (
+            f"(select *, unnest(range(ceil(len * {t})::bigint, least({longest_partner}, "
+            f"floor((len - pos + 1) * (1 + {t}) / {t} - len + 1e-9))::bigint + 1)) as partner_len "
+            f"from {probe_entries} "
+            f"where token between {self._heavy_tids[0]} and {self._heavy_tids[1]})"
+        )
+
+    def report_skew(self, index_entries: str, probe_entries: str, longest_partner: str):
+        # rows the join of the heavy tokens hands to the filters, on the token alone and bucketed by length
+        if self._stats is None or self._heavy_tids is None:
+            return
+        heavy = f"token between {self._heavy_tids[0]} and {self._heavy_tids[1]}"
+        plain, bucketed = self._con.execute(
+            "select ("
+            "select sum(I.c * P.c) "
+            f"from (select token, count(*) as c from {index_entries} where {heavy} group by token) I, "
+            f"(select token, count(*) as c from {probe_entries} where {heavy} group by token) P "
+            "where I.token = P.token"
+            "), ("
+            "select sum(I.c * P.c) "
+            f"from (select token, len, count(*) as c from {index_entries} where {heavy} group by token, len) I, "
+            "(select token, partner_len, count(*) as c "
+            f"from {self.bucketed_entries(probe_entries, longest_partner)} group by token, partner_len) P "
+            "where I.token = P.token and I.len = P.partner_len"
+            ")"
+        ).fetchall()[0]
+        rows = self._stats['rows']
+        rows['heavy_pairs'] = rows.get('heavy_pairs', 0) + int(plain or 0)
+        rows['heavy_bucketed_pairs'] = rows.get('heavy_bucketed_pairs', 0) + int(bucketed or 0)
 
     def do_brute_force_join(self):
+        written = _written_bytes()
+        self.start_stats()
         try:
-            self.tokenize()
-            self.matches_brute_force()
+            self.stage(self.tokenize)
+            self.stage(self.matches_brute_force)
         finally:
             self.clear()
+            self.stop_stats(written)
+
+    def start_stats(self):
+        # stats are filled in as the join runs: wall time per stage ('stages'), row counts of the intermediates
+        # ('rows'), filter selectivity ('pruning') and, with profile=True, the DuckDB profile of every statement
+        # that materializes an intermediate ('profiles'); without a stats dict nothing is measured
+        if self._profile and self._stats is None:
+            raise ValueError("profile needs a stats dict to report to")
+        if self._stats is None:
+            return
+        self._stats.update(stages={}, rows={}, pruning={})
+        if self._profile:
+            self._stats['profiles'] = {}
+            self._con.execute("set enable_profiling = 'no_output'")
+
+    def stop_stats(self, written):
+        if self._stats is None:
+            return
+        if self._profile:
+            self._con.execute("reset enable_profiling")
+        # compare with temporary=False to see the WAL and checkpoint traffic saved by temporary intermediates
+        if written is not None:
+            self._stats['written_bytes'] = _written_bytes() - written
+
+    def stage(self, step, *args):
+        self._stage = step.__name__
+        start = time.perf_counter()
+        try:
+            return step(*args)
+        finally:
+            if self._stats is not None:
+                stages = self._stats['stages']
+                stages[self._stage] = stages.get(self._stage, 0) + time.perf_counter() - start
+
+    def observe(self, rows: str, table: str, profiled: bool = True):
+        # count an intermediate right after the statement that created it, while its profile is the last one
+        if self._stats is None:
+            return
+        if profiled:
+            self.profile_last_statement()
+        counts = self._stats['rows']
+        counts[rows] = counts.get(rows, 0) + self._con.execute(f"select count(*) from {table}").fetchall()[0][0]
+
+    def profile_last_statement(self):
+        if self._profile:
+            self._stats['profiles'].setdefault(self._stage, []).append(
+                json.loads(self._con.get_profiling_information(format='json'))
+            )
+
+    def score_columns(self, overlap: str, l_len: str, r_len: str):
+        # the exact overlap and Jaccard similarity of every output pair, on request
+        if not self._scores:
+            return ""
+        return f", {overlap} as overlap, {overlap} / ({l_len} + {r_len} - {overlap}) as jaccard "
+
+    def report_pruning(self):
+        if self._stats is None:
+            return
+        rows = self._stats['rows']
+        if 'candidates' in rows:
+            self._stats['pruning']['candidates_per_pair'] = rows['candidates'] / self._pairs if self._pairs else 0.0
+            # with dedup the candidates are pairs of values, as are the matches they verify to
+            if 'verified_candidates' in rows:
+                self._stats['pruning']['verified_per_candidate'] = \
+                    rows['verified_candidates'] / rows['candidates'] if rows['candidates'] else 0.0
+            matches = rows.get('value_matches', rows.get('matches'))
+            if matches is not None:
+                self._stats['pruning']['matches_per_candidate'] = \
+                    matches / rows['candidates'] if rows['candidates'] else 0.0
+        if 'heavy_pairs' in rows:
+            self._stats['pruning']['heavy_bucketed_per_pair'] = \
+                rows['heavy_bucketed_pairs'] / rows['heavy_pairs'] if rows['heavy_pairs'] else 0.0
 
     @abstractmethod
     def tokenize(self):
@@ -95,118 +1090,313 @@ class _JaccardTemplateJoin(ABC):
     def candidates(self):
         pass
 
+    @abstractmethod
+    def candidates_query(self):
+        pass
+
+    @abstractmethod
+    def candidate_sides(self):
+        # the column prefix of each side of the candidate set (L of Lid, LmaxPos, ...) and its tokens table
+        pass
+
+    @abstractmethod
+    def prefix_matches_query(self, index_entries: str, probe_entries: str, token_filter: str):
+        pass
+
     @abstractmethod
     def matches(self):
         pass
 
     @abstractmethod
-    def matches_brute_force(self):
+    def matches_query(self):
         pass
 
     @abstractmethod
-    def clear(self):
+    def expand_query(self, value_pairs: str):
+        pass
+
+    @abstractmethod
+    def estimated_matches_query(self, estimates: str):
+        pass
+
+    @abstractmethod
+    def snapshot_tables(self):
+        pass
+
+    @abstractmethod
+    def probe_lengths_query(self):
+        pass
+
+    @abstractmethod
+    def probe_cost_query(self):
+        pass
+
+    @abstractmethod
+    def native_matches(self):
+        pass
+
+    @abstractmethod
+    def out_columns(self):
+        pass
+
+    @abstractmethod
+    def topk_partners_query(self, l_col: str, r_col: str):
+        pass
+
+    @abstractmethod
+    def topk_records(self):
+        pass
+
+    @abstractmethod
+    def matches_brute_force(self):
         pass
 
+    def clear(self):
+        # every intermediate lives in the namespace of this join, whichever stage left it behind
+        for database, schema, table in self._con.execute(
+                "select database_name, schema_name, table_name "
+                "from duckdb_tables() "
+                "where starts_with(table_name, ?)",
+                [self._ns]
+        ).fetchall():
+            self._con.execute(f"drop table if exists {database}.{schema}.{table}")
+
 
 class _JaccardSelfJoin(_JaccardTemplateJoin):
 
     def tokenize(self):
+        source = self.collapse(self._table, self._key_attr, self._join_attr, f"{self._ns}duplicates")
         self._con.execute(
-            f"drop table if exists {TOKENS_VIEW}"
+            f"drop table if exists {self._ns}{TOKENS_VIEW}"
         ).execute(
-            f"create table {TOKENS_VIEW} as " + self._tokenizer.query(
-                from_table=self._table,
+            f"{self._create_table} {self._ns}{TOKENS_VIEW} as " + self._tokenizer.query(
+                from_table=source,
                 key=self._key_attr, val=self._join_attr
             )
         )
+        self.observe('tokens', f"{self._ns}{TOKENS_VIEW}")
+        if self._duplicates:
+            # the shared values with tokens, and their length: their records are identical pairs
+            self._con.execute(
+                f"drop table if exists {self._ns}identical"
+            ).execute(
+                f"{self._create_table} {self._ns}identical as "
+                "select D.rep, D.keys, T.len "
+                f"from {self._ns}duplicates D, ("
+                f"select {self._key_attr} as rep, any_value(len) as len "
+                f"from {self._ns}{TOKENS_VIEW} "
+                f"where {self._key_attr} in (select rep from {self._ns}duplicates) "
+                f"group by {self._key_attr}"
+                ") T "
+                "where D.rep = T.rep"
+            )
+        if self._stats is not None:
+            self.observe('records', self._table, profiled=False)
+            self._pairs = self._stats['rows']['records'] * (self._stats['rows']['records'] - 1) // 2
 
     def document_frequency(self):
         self._con.execute(
-            f"drop table if exists {DOC_FREQ_VIEW}"
+            f"drop table if exists {self._ns}{DOC_FREQ_VIEW}"
         ).execute(
-            f"CREATE table {DOC_FREQ_VIEW} AS "
-            "SELECT token, count(*) AS df "
-            f"FROM {TOKENS_VIEW} "
+            # dictionary encoding: tokens become dense integer ids assigned in the global (df, token) ordering
+            f"{self._create_table} {self._ns}{DOC_FREQ_VIEW} AS "
+            "SELECT token, count(*) AS df, row_number() OVER (ORDER BY count(*), token) AS tid "
+            f"FROM {self._ns}{TOKENS_VIEW} "
             "GROUP BY token "
-        ).execute(f"drop table if exists {TOKENS_DOC_FREQ_VIEW}").execute(
-            f"CREATE table {TOKENS_DOC_FREQ_VIEW} AS "
-            f"select id, len, {TOKENS_VIEW}.token "
-            f", row_number() OVER (PARTITION BY id ORDER BY df, {TOKENS_VIEW}.token) as pos "
-            f", concat(len, '_', id) as l_id "
-            f"from {TOKENS_VIEW}, {DOC_FREQ_VIEW} "
-            f"where {TOKENS_VIEW}.token = {DOC_FREQ_VIEW}.token"
+        )
+        self.observe('distinct_tokens', f"{self._ns}{DOC_FREQ_VIEW}")
+
+        self._con.execute(f"drop table if exists {self._ns}{TOKENS_DOC_FREQ_VIEW}").execute(
+            f"{self._create_table} {self._ns}{TOKENS_DOC_FREQ_VIEW} AS "
+            f"select id, len, {self._ns}{DOC_FREQ_VIEW}.tid as token "
+            f", row_number() OVER (PARTITION BY id ORDER BY {self._ns}{DOC_FREQ_VIEW}.tid) as pos "
+            f"from {self._ns}{TOKENS_VIEW}, {self._ns}{DOC_FREQ_VIEW} "
+            f"where {self._ns}{TOKENS_VIEW}.token = {self._ns}{DOC_FREQ_VIEW}.token"
         ).execute(
-            f"drop table if exists {TOKENS_VIEW}"
+            f"drop table if exists {self._ns}{TOKENS_VIEW}"
         ).execute(
-            f"drop table if exists {DOC_FREQ_VIEW}"
+            f"drop table if exists {self._ns}{DOC_FREQ_VIEW}"
         )
 
     def prefixes(self):
-        pass
+        # the prefixes are filtered inside the candidates query, they only give the heavy tokens and are counted here
+        index_entries = (
+            f"(select * from {self._ns}{TOKENS_DOC_FREQ_VIEW} "
+            f"where {bounds.in_indexing_prefix('len', 'pos', self._t)})"
+        )
+        probe_entries = (
+            f"(select * from {self._ns}{TOKENS_DOC_FREQ_VIEW} "
+            f"where {bounds.in_probing_prefix('len', 'pos', self._t)})"
+        )
+        self.heavy_tokens(
+            self.token_pairs_query(index_entries, probe_entries),
+            f"(select count(distinct id) from {self._ns}{TOKENS_DOC_FREQ_VIEW})"
+        )
+        if self._stats is not None:
+            self._stats['rows']['prefix_entries'] = self._con.execute(
+                f"select count(*) filter (where {bounds.in_indexing_prefix('len', 'pos', self._t)}) "
+                f"+ count(*) filter (where {bounds.in_probing_prefix('len', 'pos', self._t)}) "
+                f"from {self._ns}{TOKENS_DOC_FREQ_VIEW}"
+            ).fetchall()[0][0]
+        self.report_skew(index_entries, probe_entries, 'len')
 
     def candidates(self):
         self._con.execute(
-            f"drop table if exists {CANDIDATE_SET_VIEW}"
+            f"drop table if exists {self._ns}{CANDIDATE_SET_VIEW}"
         ).execute(
-            f"CREATE table {CANDIDATE_SET_VIEW} AS "
-            "SELECT L.id AS Lid, R.id AS Rid "
-            ", MAX(L.pos) as LmaxPos, MAX(R.pos) as RmaxPos, count(*) as pfxOverlap "
-            f"FROM {TOKENS_DOC_FREQ_VIEW} L, {TOKENS_DOC_FREQ_VIEW} R "
-            "where L.l_id < R.l_id "  # pr2 longest
+            f"{self._create_table} {self._ns}{CANDIDATE_SET_VIEW} AS " + self.candidates_query()
+        )
+        self.observe('candidates', f"{self._ns}{CANDIDATE_SET_VIEW}")
+
+    def candidates_query(self):
+        tokens = f"{self._ns}{TOKENS_DOC_FREQ_VIEW}"
+        return (
+            "SELECT Lid, Rid "
+            ", MAX(Lpos) as LmaxPos, MAX(Rpos) as RmaxPos, count(*) as pfxOverlap "
+            f"FROM ({self.skew_matches_query(tokens, tokens, ('L', 'R'), 'len')}) "
+            "GROUP BY Lid, Rid "
+        )
+
+    def candidate_sides(self):
+        return ('L', f"{self._ns}{TOKENS_DOC_FREQ_VIEW}"), ('R', f"{self._ns}{TOKENS_DOC_FREQ_VIEW}")
+
+    def prefix_matches_query(self, l_entries: str, r_entries: str, token_filter: str):
+        return (
+            "SELECT L.id AS Lid, R.id AS Rid, L.pos AS Lpos, R.pos AS Rpos "
+            f"FROM {l_entries} L, {r_entries} R "
+            "where (L.len, L.id) < (R.len, R.id) "  # pr2 longest
             "AND L.token = R.token "
+            + token_filter +
             # length filter
-            f"AND L.len >= (R.len * {self._t})"  # pr2 longest
+            f"AND {bounds.length_at_least('L.len', 'R.len', self._t)} "  # pr2 longest
             # prefix filter
-            f"AND L.len - L.pos + 1 >= (L.len * 2 * {self._t} / (1 + {self._t})) "  # indexing prefix
-            f"AND R.len - R.pos + 1 >= (R.len * {self._t}) "  # probing prefix
+            f"AND {bounds.in_indexing_prefix('L.len', 'L.pos', self._t)} "  # indexing prefix
+            f"AND {bounds.in_probing_prefix('R.len', 'R.pos', self._t)} "  # probing prefix
             # positional filter
-            "AND LEAST((L.len - L.pos + 1), (R.len - R.pos + 1)) >= "
-            f"((L.len + R.len) * {self._t} / (1 + {self._t})) "
-            "GROUP BY L.id, R.id "
+            "AND " + bounds.overlap_at_least(
+                "LEAST((L.len - L.pos + 1), (R.len - R.pos + 1))", "L.len", "R.len", self._t
+            ) + " "
+            + self.length_range_filter('R') + self.settled_filter('L', 'R')
         )
 
     def matches(self):
         self._con.execute(
             f"drop table if exists {self._out_table}"
         ).execute(
-            # Start from the last match included to include the pairs in which the prefixes match entirely but the
-            # suffixes do not match at all
-            f"create table {self._out_table} as "
+            f"{self._create_out_table} {self._out_table} as " + self.matches_query()
+        )
+        self.observe('matches', self._out_table)
+        self._con.execute(
+            f"drop table if exists {self._ns}{CANDIDATE_SET_VIEW}"
+        ).execute(
+            f"drop table if exists {self._ns}{TOKENS_DOC_FREQ_VIEW}"
+        )
+
+    def matches_query(self):
+        # Start from the last match included to include the pairs in which the prefixes match entirely but the
+        # suffixes do not match at all
+        return (
             f"select L.id as {self._l_out_prefix}{self._key_attr}, R.id as {self._r_out_prefix}{self._key_attr} "
-            f"from {TOKENS_DOC_FREQ_VIEW} L, {TOKENS_DOC_FREQ_VIEW} R, {CANDIDATE_SET_VIEW} c "
+            + self.score_columns("(count(*) + pfxOverlap - 1)", "L.len", "R.len") +
+            f"from {self._ns}{TOKENS_DOC_FREQ_VIEW} L, {self._ns}{TOKENS_DOC_FREQ_VIEW} R, {self._ns}{CANDIDATE_SET_VIEW} c "
             "where c.Lid = L.id "
             "and c.Rid = R.id "
             "and L.token = R.token "
             "and L.pos >= LmaxPos "
             "and R.pos >= RmaxPos "
             "group by L.id, R.id, L.len, R.len, pfxOverlap "
-            f"having count(*) + pfxOverlap - 1 >= ((L.len + R.len) * {self._t} / (1+{self._t}))"
-        ).execute(
-            f"drop table if exists {CANDIDATE_SET_VIEW}"
-        ).execute(
-            f"drop table if exists {TOKENS_DOC_FREQ_VIEW}"
+            f"having {bounds.overlap_at_least('count(*) + pfxOverlap - 1', 'L.len', 'R.len', self._t)}"
+        )
+
+    def estimated_matches_query(self, estimates: str):
+        # the overlap that goes with the estimated similarity, so that the scores agree
+        return (
+            f"select Lid as {self._l_out_prefix}{self._key_attr}, Rid as {self._r_out_prefix}{self._key_attr} "
+            + self.score_columns("round(estimate * (Llen + Rlen) / (1 + estimate))", "Llen", "Rlen") +
+            f"from {estimates} "
+            f"where estimate >= {self._t}"
+        )
+
+    def native_matches(self):
+        from py_duckdb.similarity_join.join import native
+
+        records = native.fetch_records(self._con, f"{self._ns}{TOKENS_DOC_FREQ_VIEW}")
+        l_rec, r_rec, overlap = native.self_join(records, self._t, self._stats and self._stats['rows'])
+        native.write_pairs(self._con, self._create_out_table, self._out_table, f"{self._ns}pairs", {
+            f"{self._l_out_prefix}{self._key_attr}": records.ids.take(l_rec),
+            f"{self._r_out_prefix}{self._key_attr}": records.ids.take(r_rec),
+            **native.score_columns(records.lens[l_rec], records.lens[r_rec], overlap, self._scores)
+        })
+        self.observe('matches', self._out_table, profiled=False)
+
+    def expand_query(self, value_pairs: str):
+        l_col, r_col = self.out_columns()
+        members = f"(select rep, len, unnest(keys) as member from {self._ns}identical)"
+        return (
+            self.key_pairs_query(value_pairs, f"{self._ns}duplicates", f"{self._ns}duplicates")
+            + "union all "
+            f"select L.member as {l_col}, R.member as {r_col}"
+            + (", L.len as overlap, 1.0::double as jaccard " if self._scores else " ") +
+            f"from {members} L, {members} R "
+            "where L.rep = R.rep "
+            "and L.member < R.member"
+        )
+
+    def snapshot_tables(self):
+        return [f"{self._ns}{TOKENS_DOC_FREQ_VIEW}"]
+
+    def out_columns(self):
+        return f"{self._l_out_prefix}{self._key_attr}", f"{self._r_out_prefix}{self._key_attr}"
+
+    def topk_partners_query(self, l_col: str, r_col: str):
+        # every record of a self join is a left record, with the pairs in both orientations
+        return (
+            f"select {l_col} as id, {r_col} as partner, overlap, jaccard from {self._ns}topk "
+            "union all "
+            f"select {r_col} as id, {l_col} as partner, overlap, jaccard from {self._ns}topk"
+        )
+
+    def topk_records(self):
+        return self._con.execute(f"select count(*) from {self._table}").fetchall()[0][0]
+
+    def probe_lengths_query(self):
+        return (
+            "select len, count(distinct id) "
+            f"from {self._ns}{TOKENS_DOC_FREQ_VIEW} "
+            "group by len "
+            "order by len"
+        )
+
+    def probe_cost_query(self):
+        # rows of the prefix join by probe length: every probing prefix entry meets the indexing postings of its token
+        return (
+            "select P.len, sum(I.postings) "
+            f"from {self._ns}{TOKENS_DOC_FREQ_VIEW} P, ( "
+            "select token, count(*) as postings "
+            f"from {self._ns}{TOKENS_DOC_FREQ_VIEW} "
+            f"where {bounds.in_indexing_prefix('len', 'pos', self._t)} "
+            "group by token "
+            ") I "
+            "where P.token = I.token "
+            f"and {bounds.in_probing_prefix('P.len', 'P.pos', self._t)} "
+            "group by P.len "
+            "order by P.len"
         )
 
     def matches_brute_force(self):
         self._con.execute(
             f"drop table if exists {self._out_table}"
         ).execute(
-            f"create table {self._out_table} as "
+            f"{self._create_out_table} {self._out_table} as "
             f"select L.id as {self._l_out_prefix}{self._key_attr}, R.id as {self._r_out_prefix}{self._key_attr} "
-            f"from {TOKENS_VIEW} as L, {TOKENS_VIEW} as R "
+            + self.score_columns("count(*)", "L.len", "R.len") +
+            f"from {self._ns}{TOKENS_VIEW} as L, {self._ns}{TOKENS_VIEW} as R "
             "where L.token = R.token "
             "and L.id < R.id "
             "group by L.id, L.len, R.id, R.len "
-            f"having count(*) >= ((L.len + R.len) * {self._t} / (1+{self._t}))"
-        )
-
-    def clear(self):
-        self._con.execute(
-            f"drop table if exists {TOKENS_VIEW};"
-            f"drop table if exists {DOC_FREQ_VIEW};"
-            f"drop table if exists {TOKENS_DOC_FREQ_VIEW};"
-            f"drop table if exists {CANDIDATE_SET_VIEW};"
+            f"having {bounds.overlap_at_least('count(*)', 'L.len', 'R.len', self._t)}"
         )
+        self.observe('matches', self._out_table)
 
     def __init__(
             self,
@@ -218,12 +1408,19 @@ class _JaccardSelfJoin(_JaccardTemplateJoin):
             threshold: float,
             out_table: str,
             l_out_prefix: str,
-            r_out_prefix: str
+            r_out_prefix: str,
+            temporary: bool = True,
+            stats: dict = None,
+            profile: bool = False,
+            scores: bool = False,
+            temporary_out: bool = False,
+            skew: bool = True,
+            dedup: bool = False,
+            prune: bool = True
     ):
-        self._con = con
-        self._tokenizer = tokenizer
-        self._t = threshold
-        self._out_table = out_table
+        super().__init__(
+            con, tokenizer, threshold, out_table, temporary, stats, profile, scores, temporary_out, skew, dedup, prune
+        )
 
         self._table = table
         self._key_attr = key_attr
@@ -244,23 +1441,34 @@ class _JaccardInnerJoin(_JaccardTemplateJoin):
             f"from {self._r['table']}"
         ).fetchall()[0][0]
 
+        source = self.collapse(
+            self._l['table'], self._l['key_attr'], self._l['join_attr'], f"{self._ns}l_duplicates"
+        )
         self._con.execute(
-            f"drop table if exists l_{TOKENS_VIEW}"
+            f"drop table if exists {self._ns}l_{TOKENS_VIEW}"
         ).execute(
-            f"create table l_{TOKENS_VIEW} as " + self._tokenizer.query(
-                from_table=self._l['table'],
+            f"{self._create_table} {self._ns}l_{TOKENS_VIEW} as " + self._tokenizer.query(
+                from_table=source,
                 key=self._l['key_attr'], val=self._l['join_attr']
             )
         )
+        self.observe('tokens', f"{self._ns}l_{TOKENS_VIEW}")
 
+        source = self.collapse(
+            self._r['table'], self._r['key_attr'], self._r['join_attr'], f"{self._ns}r_duplicates"
+        )
         self._con.execute(
-            f"drop table if exists r_{TOKENS_VIEW}"
+            f"drop table if exists {self._ns}r_{TOKENS_VIEW}"
         ).execute(
-            f"create table r_{TOKENS_VIEW} as " + self._tokenizer.query(
-                from_table=self._r['table'],
+            f"{self._create_table} {self._ns}r_{TOKENS_VIEW} as " + self._tokenizer.query(
+                from_table=source,
                 key=self._r['key_attr'], val=self._r['join_attr']
             )
         )
+        self.observe('tokens', f"{self._ns}r_{TOKENS_VIEW}")
+        if self._stats is not None:
+            self._stats['rows']['records'] = self._l['count'] + self._r['count']
+            self._pairs = self._l['count'] * self._r['count']
 
     def document_frequency(self):
         # the document frequency of widow tokens is the max possible df + 1
@@ -268,168 +1476,319 @@ class _JaccardInnerJoin(_JaccardTemplateJoin):
         self._widow_placeholder = self._l['count'] * self._r['count'] + 1
 
         self._con.execute(
-            f"drop table if exists full_outer_{DOC_FREQ_VIEW}"
+            f"drop table if exists {self._ns}full_outer_{DOC_FREQ_VIEW}"
         ).execute(
-            f"create table full_outer_{DOC_FREQ_VIEW} as "
+            f"{self._create_table} {self._ns}full_outer_{DOC_FREQ_VIEW} as "
             "select l_tks.token as l_tk, l_tks.df as l_df, r_tks.token as r_tk, r_tks.df as r_df "
             "from ("
             "SELECT token, count(*) AS df "
-            f"FROM l_{TOKENS_VIEW} "
+            f"FROM {self._ns}l_{TOKENS_VIEW} "
             "GROUP BY token "
             ") as l_tks "
             "full outer join ("
             "SELECT token, count(*) AS df "
-            f"FROM r_{TOKENS_VIEW} "
+            f"FROM {self._ns}r_{TOKENS_VIEW} "
             "GROUP BY token "
             ") as r_tks "
             "on l_tks.token = r_tks.token"
         )
 
         self._con.execute(
-            f"drop table if exists {DOC_FREQ_VIEW}"
+            f"drop table if exists {self._ns}{DOC_FREQ_VIEW}"
         ).execute(
             # Include widows, with df=null
-            f"create table {DOC_FREQ_VIEW} as "
+            # dictionary encoding: tokens become dense integer ids assigned in the global (df, token) ordering
+            f"{self._create_table} {self._ns}{DOC_FREQ_VIEW} as "
+            "select token, df, row_number() OVER (ORDER BY df, token) as tid "
+            "from ( "
             f"select coalesce(l_tk, r_tk) as token, coalesce(l_df * r_df, {self._widow_placeholder}) as df "
-            f"from full_outer_{DOC_FREQ_VIEW} "
+            f"from {self._ns}full_outer_{DOC_FREQ_VIEW} "
+            ")"
         )
+        self.observe('distinct_tokens', f"{self._ns}{DOC_FREQ_VIEW}")
 
         self._con.execute(
-            f"drop table if exists {self._l['out_prefix']}{TOKENS_DOC_FREQ_VIEW}"
+            f"drop table if exists {self._ns}{self._l['out_prefix']}{TOKENS_DOC_FREQ_VIEW}"
         ).execute(
-            f"create table {self._l['out_prefix']}{TOKENS_DOC_FREQ_VIEW} as "
-            f"select l_{TOKENS_VIEW}.*, {DOC_FREQ_VIEW}.df "
-            f", row_number() OVER (PARTITION BY id ORDER BY df, l_{TOKENS_VIEW}.token) as pos "
-            f"from l_{TOKENS_VIEW}, {DOC_FREQ_VIEW} "
-            f"where l_{TOKENS_VIEW}.token = {DOC_FREQ_VIEW}.token"
+            f"{self._create_table} {self._ns}{self._l['out_prefix']}{TOKENS_DOC_FREQ_VIEW} as "
+            f"select {self._ns}l_{TOKENS_VIEW}.* EXCLUDE (token) "
+            f", {self._ns}{DOC_FREQ_VIEW}.tid as token, {self._ns}{DOC_FREQ_VIEW}.df "
+            f", row_number() OVER (PARTITION BY id ORDER BY {self._ns}{DOC_FREQ_VIEW}.tid) as pos "
+            f"from {self._ns}l_{TOKENS_VIEW}, {self._ns}{DOC_FREQ_VIEW} "
+            f"where {self._ns}l_{TOKENS_VIEW}.token = {self._ns}{DOC_FREQ_VIEW}.token"
         ).execute(
-            f"drop table if exists l_{TOKENS_VIEW}"
+            f"drop table if exists {self._ns}l_{TOKENS_VIEW}"
         )
         self._con.execute(
-            f"drop table if exists {self._r['out_prefix']}{TOKENS_DOC_FREQ_VIEW}"
+            f"drop table if exists {self._ns}{self._r['out_prefix']}{TOKENS_DOC_FREQ_VIEW}"
         ).execute(
-            f"create table {self._r['out_prefix']}{TOKENS_DOC_FREQ_VIEW} as "
-            f"select r_{TOKENS_VIEW}.*, {DOC_FREQ_VIEW}.df "
-            f", row_number() OVER (PARTITION BY id ORDER BY df, r_{TOKENS_VIEW}.token) as pos "
-            f"from r_{TOKENS_VIEW}, {DOC_FREQ_VIEW} "
-            f"where r_{TOKENS_VIEW}.token = {DOC_FREQ_VIEW}.token"
+            f"{self._create_table} {self._ns}{self._r['out_prefix']}{TOKENS_DOC_FREQ_VIEW} as "
+            f"select {self._ns}r_{TOKENS_VIEW}.* EXCLUDE (token) "
+            f", {self._ns}{DOC_FREQ_VIEW}.tid as token, {self._ns}{DOC_FREQ_VIEW}.df "
+            f", row_number() OVER (PARTITION BY id ORDER BY {self._ns}{DOC_FREQ_VIEW}.tid) as pos "
+            f"from {self._ns}r_{TOKENS_VIEW}, {self._ns}{DOC_FREQ_VIEW} "
+            f"where {self._ns}r_{TOKENS_VIEW}.token = {self._ns}{DOC_FREQ_VIEW}.token"
         ).execute(
-            f"drop table if exists r_{TOKENS_VIEW}"
+            f"drop table if exists {self._ns}r_{TOKENS_VIEW}"
         )
 
         self._con.execute(
-            f"drop table if exists {DOC_FREQ_VIEW}"
+            f"drop table if exists {self._ns}{DOC_FREQ_VIEW}"
         )
 
     def prefixes(self):
+        # both sides take their probing prefix, as either record of a pair may be the longer one; widow tokens are
+        # left out, they cannot match
+        self.plan()
+        for side in (self._R, self._S):
+            self._con.execute(
+                f"drop table if exists {self._ns}{side['out_prefix']}{PREFIXES_VIEW}"
+            ).execute(
+                f"{self._create_table} {self._ns}{side['out_prefix']}{PREFIXES_VIEW} as "
+                "select id, len, token, pos "
+                f"FROM {self._ns}{side['out_prefix']}{TOKENS_DOC_FREQ_VIEW} "
+                f"where {bounds.in_probing_prefix('len', 'pos', self._t)} "
+                f"and df <> {self._widow_placeholder}"
+            )
+        self.observe('prefix_entries', f"{self._ns}{self._S['out_prefix']}{PREFIXES_VIEW}")
+        self.observe('prefix_entries', f"{self._ns}{self._R['out_prefix']}{PREFIXES_VIEW}", profiled=False)
+        r_prefixes = f"{self._ns}{self._R['out_prefix']}{PREFIXES_VIEW}"
+        s_prefixes = f"{self._ns}{self._S['out_prefix']}{PREFIXES_VIEW}"
+        self.report_skew(self.indexing_entries(r_prefixes), s_prefixes, f"floor(len / {self._t} + 1e-9)")
+        self.report_skew(self.indexing_entries(s_prefixes), r_prefixes, f"floor(len / {self._t} + 1e-9)")
+
+    def plan(self):
+        # picks the sides from the token statistics of the two probing prefixes, before materializing them: one
+        # aggregation per side gives the probing and the indexing prefix entries of every token and the widow
+        # entries, and from them the rows the two branches of the prefix join produce for every token at most (the
+        # indexing postings of one side times the probing postings of the other), which also give the heavy tokens.
+        # The sides do not change the candidates: the lengths of S are banded (under a memory limit, in the iter and
+        # parallel joins) and every band reads R again, so that S is the side with more prefix entries
+        postings = (
+            "select token, count(*) as p, "
+            f"count(*) filter (where {bounds.in_indexing_prefix('len', 'pos', self._t)}) as i, "
+            "count(*) filter (where df = {w}) as widows "
+            "from {table} "
+            f"where {bounds.in_probing_prefix('len', 'pos', self._t)} "
+            "group by token"
+        )
         self._con.execute(
-            f"drop table if exists {self._l['out_prefix']}{PREFIXES_VIEW}"
-        ).execute(
-            f"create table {self._l['out_prefix']}{PREFIXES_VIEW} as "
-            "select id, len, token, pos, df "
-            f"FROM {self._l['out_prefix']}{TOKENS_DOC_FREQ_VIEW} "
-            f"where len - pos + 1 >= (len * 2 * {self._t} / (1+{self._t})) "  # indexing prefix
+            f"drop table if exists {self._ns}postings"
         ).execute(
-            f"drop table if exists {self._r['out_prefix']}{PREFIXES_VIEW}"
-        ).execute(
-            f"create table {self._r['out_prefix']}{PREFIXES_VIEW} as "
-            "select id, len, token, pos, df "
-            f"FROM {self._r['out_prefix']}{TOKENS_DOC_FREQ_VIEW} "
-            f"where len - pos + 1 >= (len * 2 * {self._t} / (1+{self._t})) "  # indexing prefix
+            f"{self._create_table} {self._ns}postings as "
+            "select coalesce(L.token, R.token) as token, "
+            "coalesce(L.p, 0) as l_p, coalesce(L.i, 0) as l_i, coalesce(L.widows, 0) as l_widows, "
+            "coalesce(R.p, 0) as r_p, coalesce(R.i, 0) as r_i, coalesce(R.widows, 0) as r_widows "
+            "from ("
+            + postings.format(
+                w=self._widow_placeholder, table=f"{self._ns}{self._l['out_prefix']}{TOKENS_DOC_FREQ_VIEW}"
+            ) +
+            ") L full outer join ("
+            + postings.format(
+                w=self._widow_placeholder, table=f"{self._ns}{self._r['out_prefix']}{TOKENS_DOC_FREQ_VIEW}"
+            ) +
+            ") R on L.token = R.token"
         )
+        l_entries, l_widows, r_entries, r_widows, pairs = self._con.execute(
+            "select coalesce(sum(l_p - l_widows), 0), coalesce(sum(l_widows), 0), "
+            "coalesce(sum(r_p - r_widows), 0), coalesce(sum(r_widows), 0), coalesce(sum(l_i * r_p + l_p * r_i), 0) "
+            f"from {self._ns}postings"
+        ).fetchall()[0]
+        self.heavy_tokens(
+            f"(select token, l_i * r_p + l_p * r_i as pairs from {self._ns}postings)",
+            str(self._l['count'] + self._r['count'])
+        )
+        self._con.execute(f"drop table if exists {self._ns}postings")
 
-        l_widows = self._con.execute(
-            "select count(*) "
-            f"from {self._l['out_prefix']}{PREFIXES_VIEW} "
-            f"where df = {self._widow_placeholder}"
-        ).fetchall()[0][0]
-
-        r_widows = self._con.execute(
-            "select count(*) "
-            f"from {self._r['out_prefix']}{PREFIXES_VIEW} "
-            f"where df = {self._widow_placeholder}"
-        ).fetchall()[0][0]
-
-        self._R, self._S = (self._l, self._r) if l_widows > r_widows else (self._r, self._l)
+        l_probes = l_entries >= r_entries
+        self._R, self._S = (self._r, self._l) if l_probes else (self._l, self._r)
+        if self._stats is not None:
+            self._stats['plan'] = {
+                'index': 'r' if l_probes else 'l',
+                'probe': 'l' if l_probes else 'r',
+                'prefix_entries': {'l': l_entries, 'r': r_entries},
+                'widow_entries': {'l': l_widows, 'r': r_widows},
+                'prefix_pairs': pairs
+            }
 
+    def candidates(self):
         self._con.execute(
-            f"drop table if exists {self._S['out_prefix']}{PREFIXES_VIEW}"
+            f"drop table if exists {self._ns}{CANDIDATE_SET_VIEW}"
         ).execute(
-            f"create table {self._S['out_prefix']}{PREFIXES_VIEW} as "
-            "select id, len, token, pos "
-            f"FROM {self._S['out_prefix']}{TOKENS_DOC_FREQ_VIEW} "
-            f"where len - pos + 1 >= (len * {self._t}) "  # probing prefix
+            f"{self._create_table} {self._ns}{CANDIDATE_SET_VIEW} AS " + self.candidates_query()
         )
+        self.observe('candidates', f"{self._ns}{CANDIDATE_SET_VIEW}")
+        if self._length_range is None:
+            self._con.execute(
+                f"drop table if exists {self._ns}{self._R['out_prefix']}{PREFIXES_VIEW};"
+                f"drop table if exists {self._ns}{self._S['out_prefix']}{PREFIXES_VIEW};"
+            )
 
-    def candidates(self):
-        self._con.execute(
-            f"drop table if exists {CANDIDATE_SET_VIEW}"
-        ).execute(
-            f"CREATE table {CANDIDATE_SET_VIEW} AS ("
-            "SELECT Rpfx.id AS Rid, Spfx.id AS Sid "
-            ", MAX(Rpfx.pos) as RmaxPos, MAX(Spfx.pos) as SmaxPos, count(*) as pfxOverlap "
-            f"FROM {self._R['out_prefix']}{PREFIXES_VIEW} Rpfx, {self._S['out_prefix']}{PREFIXES_VIEW} Spfx "
+    def candidates_query(self):
+        r_prefixes = f"{self._ns}{self._R['out_prefix']}{PREFIXES_VIEW}"
+        s_prefixes = f"{self._ns}{self._S['out_prefix']}{PREFIXES_VIEW}"
+        longest_partner = f"floor(len / {self._t} + 1e-9)"
+        # either record of a pair may be the shorter one, which needs only its indexing prefix: one branch joins the
+        # pairs of a shorter (or equally long) R record, the other those of a shorter S record, and every pair is in
+        # one of them only
+        branches = []
+        for self._index_alias in ('Rpfx', 'Spfx'):
+            index, probe, aliases = (r_prefixes, s_prefixes, ('Rpfx', 'Spfx')) if self._index_alias == 'Rpfx' \
+                else (s_prefixes, r_prefixes, ('Spfx', 'Rpfx'))
+            branches.append(
+                self.skew_matches_query(self.indexing_entries(index), probe, aliases, longest_partner)
+            )
+        self._index_alias = None
+        return (
+            "SELECT Rid, Sid "
+            ", MAX(Rpos) as RmaxPos, MAX(Spos) as SmaxPos, count(*) as pfxOverlap "
+            f"FROM ({'UNION ALL '.join(branches)}) "
+            "GROUP BY Rid, Sid "
+        )
+
+    def indexing_entries(self, prefixes: str):
+        return f"(select * from {prefixes} where {bounds.in_indexing_prefix('len', 'pos', self._t)})"
+
+    def candidate_sides(self):
+        return (
+            ('R', f"{self._ns}{self._R['out_prefix']}{TOKENS_DOC_FREQ_VIEW}"),
+            ('S', f"{self._ns}{self._S['out_prefix']}{TOKENS_DOC_FREQ_VIEW}")
+        )
+
+    def prefix_matches_query(self, index_entries: str, probe_entries: str, token_filter: str):
+        # the entries of the shorter records of the branch are the index entries
+        if self._index_alias == 'Rpfx':
+            r_entries, s_entries, shorter = index_entries, probe_entries, "Rpfx.len <= Spfx.len "
+        else:
+            r_entries, s_entries, shorter = probe_entries, index_entries, "Rpfx.len > Spfx.len "
+        return (
+            "SELECT Rpfx.id AS Rid, Spfx.id AS Sid, Rpfx.pos AS Rpos, Spfx.pos AS Spos "
+            f"FROM {r_entries} Rpfx, {s_entries} Spfx "
             "WHERE Rpfx.token = Spfx.token "
+            f"AND {shorter}"
+            + token_filter +
             # length filter
-            f"AND Rpfx.len >= (Spfx.len * {self._t})"
-            f"AND Spfx.len >= (Rpfx.len * {self._t})"
+            f"AND {bounds.length_at_least('Rpfx.len', 'Spfx.len', self._t)} "
+            f"AND {bounds.length_at_least('Spfx.len', 'Rpfx.len', self._t)} "
             # positional filter
-            "AND LEAST((Rpfx.len - Rpfx.pos + 1), (Spfx.len - Spfx.pos + 1)) >= "
-            f"((Rpfx.len + Spfx.len) * {self._t} / (1 + {self._t})) "
-            "GROUP BY Rpfx.id, Spfx.id "
-            ")"
-        ).execute(
-            f"drop table if exists {self._R['out_prefix']}{PREFIXES_VIEW};"
-            f"drop table if exists {self._S['out_prefix']}{PREFIXES_VIEW};"
+            "AND " + bounds.overlap_at_least(
+                "LEAST((Rpfx.len - Rpfx.pos + 1), (Spfx.len - Spfx.pos + 1))", "Rpfx.len", "Spfx.len", self._t
+            ) + " "
+            + self.length_range_filter('Spfx') + self.settled_filter(self.prefix_aliases()[0])
         )
 
     def matches(self):
         self._con.execute(
             f"drop table if exists {self._out_table}"
         ).execute(
-            f"create table {self._out_table} as "
-            f"select R.id as {self._R['out_prefix']}{self._l['key_attr']}, S.id as {self._S['out_prefix']}{self._r['key_attr']} "
-            f"from {self._R['out_prefix']}{TOKENS_DOC_FREQ_VIEW} R, {self._S['out_prefix']}{TOKENS_DOC_FREQ_VIEW} S, {CANDIDATE_SET_VIEW} c "
+            f"{self._create_out_table} {self._out_table} as " + self.matches_query()
+        )
+        self.observe('matches', self._out_table)
+        self._con.execute(
+            f"drop table if exists {self._ns}{self._l['out_prefix']}{TOKENS_DOC_FREQ_VIEW};"
+            f"drop table if exists {self._ns}{self._r['out_prefix']}{TOKENS_DOC_FREQ_VIEW};"
+        ).execute(
+            f"drop table if exists {self._ns}{CANDIDATE_SET_VIEW}"
+        )
+
+    def matches_query(self):
+        return (
+            f"select R.id as {self._R['out_prefix']}{self._R['key_attr']}, S.id as {self._S['out_prefix']}{self._S['key_attr']} "
+            + self.score_columns("(count(*) + pfxOverlap - 1)", "R.len", "S.len") +
+            f"from {self._ns}{self._R['out_prefix']}{TOKENS_DOC_FREQ_VIEW} R, {self._ns}{self._S['out_prefix']}{TOKENS_DOC_FREQ_VIEW} S, {self._ns}{CANDIDATE_SET_VIEW} c "
             "where c.Rid = R.id "
             "and c.Sid = S.id "
             "and R.token = S.token "
             "and R.pos >= RmaxPos "
             "and S.pos >= SmaxPos "
             "group by R.id, S.id, R.len, S.len, pfxOverlap "
-            f"having count(*) + pfxOverlap - 1 >= ((R.len + S.len) * {self._t} / (1+{self._t}))"
-        ).execute(
-            f"drop table if exists {self._l['out_prefix']}{TOKENS_DOC_FREQ_VIEW};"
-            f"drop table if exists {self._r['out_prefix']}{TOKENS_DOC_FREQ_VIEW};"
-        ).execute(
-            f"drop table if exists {CANDIDATE_SET_VIEW}"
+            f"having {bounds.overlap_at_least('count(*) + pfxOverlap - 1', 'R.len', 'S.len', self._t)}"
+        )
+
+    def estimated_matches_query(self, estimates: str):
+        # the overlap that goes with the estimated similarity, so that the scores agree
+        return (
+            f"select Rid as {self._R['out_prefix']}{self._R['key_attr']}, "
+            f"Sid as {self._S['out_prefix']}{self._S['key_attr']} "
+            + self.score_columns("round(estimate * (Rlen + Slen) / (1 + estimate))", "Rlen", "Slen") +
+            f"from {estimates} "
+            f"where estimate >= {self._t}"
+        )
+
+    def native_matches(self):
+        from py_duckdb.similarity_join.join import native
+
+        l_records = native.fetch_records(self._con, f"{self._ns}{self._l['out_prefix']}{TOKENS_DOC_FREQ_VIEW}")
+        r_records = native.fetch_records(self._con, f"{self._ns}{self._r['out_prefix']}{TOKENS_DOC_FREQ_VIEW}")
+        l_rec, r_rec, overlap = native.inner_join(l_records, r_records, self._t, self._stats and self._stats['rows'])
+        native.write_pairs(self._con, self._create_out_table, self._out_table, f"{self._ns}pairs", {
+            f"{self._l['out_prefix']}{self._l['key_attr']}": l_records.ids.take(l_rec),
+            f"{self._r['out_prefix']}{self._r['key_attr']}": r_records.ids.take(r_rec),
+            **native.score_columns(l_records.lens[l_rec], r_records.lens[r_rec], overlap, self._scores)
+        })
+        self.observe('matches', self._out_table, profiled=False)
+
+    def out_columns(self):
+        return f"{self._l['out_prefix']}{self._l['key_attr']}", f"{self._r['out_prefix']}{self._r['key_attr']}"
+
+    def expand_query(self, value_pairs: str):
+        # a record is never paired with one of its own side, only the pairs of values are expanded
+        return self.key_pairs_query(value_pairs, f"{self._ns}l_duplicates", f"{self._ns}r_duplicates")
+
+    def prefix_aliases(self):
+        # the candidates query alias of the left and of the right table
+        return ('Rpfx', 'Spfx') if self._R is self._l else ('Spfx', 'Rpfx')
+
+    def topk_partners_query(self, l_col: str, r_col: str):
+        return f"select {l_col} as id, {r_col} as partner, overlap, jaccard from {self._ns}topk"
+
+    def topk_records(self):
+        return self._l['count']
+
+    def snapshot_tables(self):
+        return [
+            f"{self._ns}{self._R['out_prefix']}{TOKENS_DOC_FREQ_VIEW}", f"{self._ns}{self._S['out_prefix']}{TOKENS_DOC_FREQ_VIEW}",
+            f"{self._ns}{self._R['out_prefix']}{PREFIXES_VIEW}", f"{self._ns}{self._S['out_prefix']}{PREFIXES_VIEW}"
+        ]
+
+    def probe_lengths_query(self):
+        return (
+            "select len, count(distinct id) "
+            f"from {self._ns}{self._S['out_prefix']}{TOKENS_DOC_FREQ_VIEW} "
+            "group by len "
+            "order by len"
+        )
+
+    def probe_cost_query(self):
+        # rows of the prefix join by probe length: every probing prefix entry meets the indexed postings of its token
+        return (
+            "select P.len, sum(I.postings) "
+            f"from {self._ns}{self._S['out_prefix']}{PREFIXES_VIEW} P, ( "
+            "select token, count(*) as postings "
+            f"from {self._ns}{self._R['out_prefix']}{PREFIXES_VIEW} "
+            "group by token "
+            ") I "
+            "where P.token = I.token "
+            "group by P.len "
+            "order by P.len"
         )
 
     def matches_brute_force(self):
         self._con.execute(
             f"drop table if exists {self._out_table}"
         ).execute(
-            f"create table {self._out_table} as "
+            f"{self._create_out_table} {self._out_table} as "
             f"select L.id as {self._l['out_prefix']}{self._l['key_attr']}, R.id as {self._r['out_prefix']}{self._r['key_attr']} "
-            f"from l_{TOKENS_VIEW} as L, r_{TOKENS_VIEW} as R "
+            + self.score_columns("count(*)", "L.len", "R.len") +
+            f"from {self._ns}l_{TOKENS_VIEW} as L, {self._ns}r_{TOKENS_VIEW} as R "
             "where L.token = R.token "
             "group by L.id, L.len, R.id, R.len "
-            f"having count(*) >= ((L.len + R.len) * {self._t} / (1+{self._t}))"
-        ).execute(
-            f"drop table if exists l_{TOKENS_VIEW};"
-            f"drop table if exists r_{TOKENS_VIEW};"
+            f"having {bounds.overlap_at_least('count(*)', 'L.len', 'R.len', self._t)}"
         )
-
-    def clear(self):
+        self.observe('matches', self._out_table)
         self._con.execute(
-            f"drop table if exists l_{TOKENS_VIEW};"
-            f"drop table if exists r_{TOKENS_VIEW};"
-            f"drop table if exists full_outer_{DOC_FREQ_VIEW};"
-            f"drop table if exists {DOC_FREQ_VIEW};"
-            f"drop table if exists {self._l['out_prefix']}{TOKENS_DOC_FREQ_VIEW};"
-            f"drop table if exists {self._r['out_prefix']}{TOKENS_DOC_FREQ_VIEW};"
-            f"drop table if exists {self._l['out_prefix']}{PREFIXES_VIEW};"
-            f"drop table if exists {self._r['out_prefix']}{PREFIXES_VIEW};"
-            f"drop table if exists {CANDIDATE_SET_VIEW};"
+            f"drop table if exists {self._ns}l_{TOKENS_VIEW};"
+            f"drop table if exists {self._ns}r_{TOKENS_VIEW};"
         )
 
     def __init__(
@@ -445,12 +1804,19 @@ class _JaccardInnerJoin(_JaccardTemplateJoin):
             threshold: float,
             out_table: str,
             l_out_prefix: str,
-            r_out_prefix: str
+            r_out_prefix: str,
+            temporary: bool = True,
+            stats: dict = None,
+            profile: bool = False,
+            scores: bool = False,
+            temporary_out: bool = False,
+            skew: bool = True,
+            dedup: bool = False,
+            prune: bool = True
     ):
-        self._con = con
-        self._t = threshold
-        self._tokenizer = tokenizer
-        self._out_table = out_table
+        super().__init__(
+            con, tokenizer, threshold, out_table, temporary, stats, profile, scores, temporary_out, skew, dedup, prune
+        )
 
         def to_dict(table, key_attr, join_attr, out_prefix):
             return {
@@ -465,5 +1831,7 @@ class _JaccardInnerJoin(_JaccardTemplateJoin):
         self._r = to_dict(r_table, r_key_attr, r_join_attr, r_out_prefix)
 
         self._widow_placeholder = 0
-        self._R = {}
-        self._S = {}
+        # plan() picks the sides of the prefix join, the other joins keep them in input order
+        self._R = self._l
+        self._S = self._r
+        self._index_alias = None
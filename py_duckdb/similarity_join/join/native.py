@@ -0,0 +1,230 @@
+import duckdb
+import numpy as np
+import pyarrow as pa
+
+from py_duckdb.similarity_join.join import bounds
+
+# bound on the prefix token pairs expanded at once
+_BATCH_PAIRS = 1 << 22
+
+
+class Records:
+
+    def __init__(self, table: pa.Table):
+        # records sorted by (len, id), token ids ascending within each record: the list order is the global order
+        table = table.combine_chunks()
+        self.ids = table.column('id')
+        self.lens = table.column('len').to_numpy().astype(np.int64)
+        tks = table.column('tks').chunk(0) if table.num_rows else pa.array([], pa.list_(pa.int64()))
+        self.offsets = tks.offsets.to_numpy().astype(np.int64)
+        self.tokens = tks.values.to_numpy().astype(np.int64)
+
+    def __len__(self):
+        return len(self.lens)
+
+    def prefix_entries(self, prefix_lens):
+        rec = np.repeat(np.arange(len(self)), prefix_lens)
+        starts = np.cumsum(prefix_lens) - prefix_lens
+        pos = np.arange(len(rec)) - np.repeat(starts, prefix_lens) + 1
+        return rec, pos, self.tokens[self.offsets[rec] + pos - 1]
+
+
+def records_query(tkdf: str):
+    return (
+        "select id, any_value(len) as len, list(token order by pos) as tks "
+        f"from {tkdf} "
+        "group by id "
+        "order by len, id"
+    )
+
+
+def fetch_records(con: duckdb.DuckDBPyConnection, tkdf: str):
+    return Records(con.execute(records_query(tkdf)).to_arrow_reader().read_all())
+
+
+# the bounds compare integers, with the threshold as p / q (see bounds): the products are Python integers when
+# they might overflow int64, e.g. for a threshold of many decimals
+def _scaled(values, factor: int):
+    values = np.asarray(values, dtype=np.int64)
+    if factor and int(np.abs(values).max(initial=0)) > (1 << 62) // factor:
+        return values.astype(object) * factor
+    return values * factor
+
+
+def _ceil_div(a, b: int):
+    return np.asarray(-(-a // b), dtype=np.int64)
+
+
+def _overlap_at_least(overlap, l_len, r_len, t: float):
+    # overlap * (1 + t) >= (l_len + r_len) * t
+    p, q = bounds.integer_ratio(t)
+    return np.asarray(_scaled(overlap, q + p) >= _scaled(l_len + r_len, p), dtype=bool)
+
+
+def indexing_prefix_lens(lens, t: float):
+    # (len - pos + 1) * (1 + t) >= len * 2t
+    p, q = bounds.integer_ratio(t)
+    return np.clip(lens + 1 - _ceil_div(_scaled(lens, 2 * p), q + p), 0, lens)
+
+
+def probing_prefix_lens(lens, t: float):
+    # len - pos + 1 >= len * t
+    p, q = bounds.integer_ratio(t)
+    return np.clip(lens + 1 - _ceil_div(_scaled(lens, p), q), 0, lens)
+
+
+def self_join(records: Records, t: float, counts: dict = None):
+    # the smaller record of each pair, in (len, id) order, is indexed with its indexing prefix
+    return _join(
+        records, indexing_prefix_lens(records.lens, t),
+        records, probing_prefix_lens(records.lens, t),
+        t, True, counts
+    )
+
+
+def inner_join(l_records: Records, r_records: Records, t: float, counts: dict = None):
+    # either side may be the longer one, so both use the probing prefix
+    return _join(
+        l_records, probing_prefix_lens(l_records.lens, t),
+        r_records, probing_prefix_lens(r_records.lens, t),
+        t, False, counts
+    )
+
+
+def _join(idx: Records, idx_prefix_lens, probe: Records, probe_prefix_lens, t: float, self_join: bool, counts: dict):
+    # counts, when given, receives the prefix entries and the candidate pairs as the sql engine reports them
+    # in-memory inverted index over the indexing prefixes, sorted by (token, record)
+    i_rec, i_pos, i_tok = idx.prefix_entries(idx_prefix_lens)
+    order = np.lexsort((i_rec, i_tok))
+    i_rec, i_pos, i_tok = i_rec[order], i_pos[order], i_tok[order]
+    n = max(len(idx), 1)
+    i_keys = i_tok * n + i_rec
+
+    p_rec, p_pos, p_tok = probe.prefix_entries(probe_prefix_lens)
+    p_len = probe.lens[p_rec]
+
+    # length filter: the index records of a probe entry are a contiguous range of each posting list
+    p, q = bounds.integer_ratio(t)
+    lo = np.searchsorted(idx.lens, _ceil_div(_scaled(p_len, p), q), 'left')
+    if self_join:
+        hi = p_rec
+    elif p:
+        hi = np.searchsorted(idx.lens, np.asarray(_scaled(p_len, q) // p, dtype=np.int64), 'right')
+    else:
+        hi = np.full(len(p_len), len(idx))
+    lo_entry = np.searchsorted(i_keys, p_tok * n + lo, 'left')
+    hi_entry = np.searchsorted(i_keys, p_tok * n + hi, 'left')
+    postings = np.maximum(hi_entry - lo_entry, 0)
+    if counts is not None:
+        counts['prefix_entries'] = len(i_rec) + len(p_rec)
+        counts['candidates'] = 0
+
+    l_out, r_out, overlap_out = [], [], []
+    for begin, end in _batches(p_rec, postings, len(probe)):
+        c = postings[begin:end]
+        entry = np.repeat(np.arange(begin, end), c)
+        starts = np.cumsum(c) - c
+        match = lo_entry[entry] + np.arange(len(entry)) - np.repeat(starts, c)
+
+        l_rec, l_pos, l_len = i_rec[match], i_pos[match], idx.lens[i_rec[match]]
+        r_rec, r_pos, r_len = p_rec[entry], p_pos[entry], p_len[entry]
+
+        # positional filter
+        keep = _overlap_at_least(np.minimum(l_len - l_pos + 1, r_len - r_pos + 1), l_len, r_len, t)
+        l_rec, l_pos, r_rec, r_pos = l_rec[keep], l_pos[keep], r_rec[keep], r_pos[keep]
+
+        candidates = _candidates(l_rec, l_pos, r_rec, r_pos, len(probe))
+        if counts is not None:
+            counts['candidates'] += len(candidates[0])
+        l_rec, r_rec, overlap = _verify(idx, probe, t, *candidates)
+        l_len, r_len = idx.lens[l_rec], probe.lens[r_rec]
+        keep = _overlap_at_least(overlap, l_len, r_len, t)
+        l_out.append(l_rec[keep])
+        r_out.append(r_rec[keep])
+        overlap_out.append(overlap[keep])
+
+    if not l_out:
+        return np.empty(0, np.int64), np.empty(0, np.int64), np.empty(0, np.int64)
+    return np.concatenate(l_out), np.concatenate(r_out), np.concatenate(overlap_out)
+
+
+def _batches(p_rec, counts, records: int):
+    # cut the probe entries at record boundaries, so that every candidate pair is complete within one batch
+    per_record = np.cumsum(np.bincount(p_rec, weights=counts, minlength=records))
+    begin = 0
+    while begin < records:
+        done = per_record[begin - 1] if begin else 0
+        end = max(int(np.searchsorted(per_record, done + _BATCH_PAIRS, 'right')), begin + 1)
+        yield int(np.searchsorted(p_rec, begin, 'left')), int(np.searchsorted(p_rec, end, 'left'))
+        begin = end
+
+
+def _candidates(l_rec, l_pos, r_rec, r_pos, r_count: int):
+    # prefix overlap and last matching prefix positions of every candidate pair
+    keys = l_rec * max(r_count, 1) + r_rec
+    order = np.argsort(keys, kind='stable')
+    keys, l_pos, r_pos = keys[order], l_pos[order], r_pos[order]
+    if not len(keys):
+        empty = np.empty(0, np.int64)
+        return empty, empty, empty, empty, empty
+    first = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    pairs = keys[first]
+    return (
+        pairs // max(r_count, 1), pairs % max(r_count, 1),
+        np.diff(np.r_[first, len(keys)]),
+        np.maximum.reduceat(l_pos, first), np.maximum.reduceat(r_pos, first)
+    )
+
+
+def _verify(idx: Records, probe: Records, t: float, l_rec, r_rec, pfx_overlap, l_max_pos, r_max_pos):
+    l_len, r_len = idx.lens[l_rec], probe.lens[r_rec]
+    l_sfx, r_sfx = l_len - l_max_pos, r_len - r_max_pos
+
+    # early termination: pairs whose shorter suffix cannot make up for the missing overlap are never merged
+    keep = _overlap_at_least(pfx_overlap + np.minimum(l_sfx, r_sfx), l_len, r_len, t)
+    l_rec, r_rec, pfx_overlap = l_rec[keep], r_rec[keep], pfx_overlap[keep]
+    l_max_pos, r_max_pos, l_sfx, r_sfx = l_max_pos[keep], r_max_pos[keep], l_sfx[keep], r_sfx[keep]
+
+    # merge the suffixes after the last prefix match, all the pairs of a chunk at once: each suffix token is keyed
+    # by its pair, so that the keys common to both sides are the overlapping tokens
+    vocab = max(int(idx.tokens.max(initial=0)), int(probe.tokens.max(initial=0))) + 1
+    overlap = pfx_overlap.copy()
+    cum = np.cumsum(l_sfx + r_sfx)
+    begin = 0
+    while begin < len(l_rec):
+        done = cum[begin - 1] if begin else 0
+        end = max(int(np.searchsorted(cum, done + _BATCH_PAIRS, 'right')), begin + 1)
+        # the keys of a pair are unique as the records are sets of distinct tokens (see jaccard_join._check_engine)
+        common = np.intersect1d(
+            _suffix_keys(idx, l_rec[begin:end], l_max_pos[begin:end], l_sfx[begin:end], vocab),
+            _suffix_keys(probe, r_rec[begin:end], r_max_pos[begin:end], r_sfx[begin:end], vocab),
+            assume_unique=True
+        )
+        overlap[begin:end] += np.bincount(common // vocab, minlength=end - begin)
+        begin = end
+    return l_rec, r_rec, overlap
+
+
+def _suffix_keys(records: Records, rec, max_pos, sfx, vocab: int):
+    pair = np.repeat(np.arange(len(rec)), sfx)
+    starts = np.cumsum(sfx) - sfx
+    at = np.repeat(records.offsets[rec] + max_pos, sfx) + np.arange(len(pair)) - np.repeat(starts, sfx)
+    return pair * vocab + records.tokens[at]
+
+
+def score_columns(l_lens, r_lens, overlap, scores: bool):
+    if not scores:
+        return {}
+    return {'overlap': overlap, 'jaccard': overlap / (l_lens + r_lens - overlap)}
+
+
+def write_pairs(con: duckdb.DuckDBPyConnection, create_table: str, out_table: str, view: str, columns: dict):
+    con.register(view, pa.table(columns))
+    try:
+        con.execute(
+            f"drop table if exists {out_table}"
+        ).execute(
+            f"{create_table} {out_table} as select * from {view}"
+        )
+    finally:
+        con.unregister(view)
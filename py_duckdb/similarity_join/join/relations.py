@@ -0,0 +1,87 @@
+import contextlib
+
+import duckdb
+
+from py_duckdb.similarity_join.default_names import scratch_namespace
+
+OUTPUTS = ('table', 'arrow', 'parquet')
+
+
+def is_parquet(source):
+    return isinstance(source, str) and source.lower().endswith('.parquet')
+
+
+def _same(l_source, r_source):
+    # DataFrames compare element-wise, so objects are the same source only when they are the same object
+    if isinstance(l_source, str) and isinstance(r_source, str):
+        return l_source == r_source
+    return l_source is r_source
+
+
+@contextlib.contextmanager
+def inputs(con: duckdb.DuckDBPyConnection, l_source, r_source):
+    # yields the two sources as names the join queries can select from: table and view names pass through, Parquet
+    # files and globs (e.g. 'data/*/*.parquet', hive partitions included) are scanned with read_parquet(), and
+    # Python objects (Arrow tables, datasets and record batch readers, pandas DataFrames, relations of con) are
+    # registered on con for the duration of the join, so that DuckDB scans them in place instead of copying them
+    # the right source comes out empty for a self join, as the join functions expect it
+    ns = scratch_namespace()
+    registered = []
+
+    def resolve(source, side: str):
+        if isinstance(source, str) or source is None:
+            return f"read_parquet('{source}')" if is_parquet(source) else source
+        name = f"{ns}{side}"
+        con.register(name, source)
+        registered.append(name)
+        return name
+
+    try:
+        l_table = resolve(l_source, 'l')
+        r_table = '' if r_source is None or _same(l_source, r_source) else resolve(r_source, 'r')
+        yield l_table, r_table
+    finally:
+        for name in registered:
+            con.unregister(name)
+
+
+class Output:
+
+    def __init__(self, con: duckdb.DuckDBPyConnection, output: str, out_table: str, partition_by: list[str] = None):
+        # output 'table' writes the pairs to the table out_table as before, 'parquet' writes them to the file
+        # out_table, or with partition_by to a hive partitioned directory of that name, and 'arrow' returns them.
+        # The last two are still staged in a temp table, which never reaches the database file, rather than streamed
+        # with copy (...) to: the joins build their output in several statements (the matches, then the expanded
+        # duplicates, the bands or shards, the top-k steps), so that no single query holds all the pairs
+        if output not in OUTPUTS:
+            raise ValueError(f"unknown output {output}")
+        if output == 'parquet' and not out_table:
+            raise ValueError("a parquet output needs a path")
+        if partition_by and output != 'parquet':
+            raise ValueError("partition_by needs a parquet output")
+        self._con = con
+        self._output = output
+        self._out_table = out_table
+        self._partition_by = partition_by
+        self.temporary = output != 'table'
+        self.table = f"{scratch_namespace()}out" if self.temporary else out_table
+        # what the join returns: the connection, or the pairs for an arrow output
+        self.result = con
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if not self.temporary:
+            return False
+        try:
+            if exc_type is None and self._output == 'arrow':
+                self.result = self._con.execute(f"select * from {self.table}").to_arrow_table()
+            elif exc_type is None:
+                options = ["format parquet"]
+                if self._partition_by:
+                    options += [f"partition_by ({', '.join(self._partition_by)})", "overwrite true"]
+                self._con.execute(f"copy {self.table} to '{self._out_table}' ({', '.join(options)})")
+        finally:
+            self._con.execute(f"drop table if exists {self.table}")
+        return False
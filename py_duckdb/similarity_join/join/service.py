@@ -0,0 +1,218 @@
+import asyncio
+import collections
+import json
+import time
+
+import duckdb
+
+from py_duckdb.similarity_join.join.jaccard_index import JaccardIndex
+from py_duckdb.similarity_join.default_names import scratch_namespace
+
+
+class _Request:
+
+    def __init__(self, records: list, future: asyncio.Future):
+        self.records = records
+        self.future = future
+        self.start = time.perf_counter()
+
+
+def _closed(request: _Request):
+    if not request.future.done():
+        request.future.set_exception(RuntimeError("the service is closed"))
+
+
+class JaccardService:
+
+    def __init__(
+            self,
+            con: duckdb.DuckDBPyConnection,
+            index: str,
+            threshold: float,
+            workers: int = 1,
+            max_batch: int = 1_000,
+            max_wait: float = 0.002,
+            latency_window: int = 10_000
+    ):
+        # matches probe records against the JaccardIndex named index, for many small concurrent requests: the
+        # requests that arrive while a worker is busy are joined together as one batch of up to max_batch records,
+        # after waiting up to max_wait seconds for more once the first one is in. Each worker keeps its own cursor
+        # of con and runs a single query per batch (see JaccardIndex.probe_query), so that the index tables stay
+        # warm in DuckDB's buffer pool and no request pays for connecting or DDL
+        self._con = con
+        self._index = index
+        self._t = threshold
+        self._workers = workers
+        self._max_batch = max_batch
+        self._max_wait = max_wait
+        self._ns = scratch_namespace()
+        self._queue = None
+        self._tasks = []
+        self._cursors = []
+        # latencies of the last latency_window requests, in seconds from match() to its result
+        self._latencies = collections.deque(maxlen=latency_window)
+        self._counts = {'requests': 0, 'records': 0, 'batches': 0, 'matches': 0}
+
+        # the index is opened here once, to fail early on a missing index or a threshold below its minimum
+        if threshold < JaccardIndex(con, index).min_threshold:
+            raise ValueError(f"threshold {threshold} is below the index minimum threshold")
+
+    async def start(self):
+        self._queue = asyncio.Queue()
+        for worker in range(self._workers):
+            cursor = self._con.cursor()
+            self._cursors.append(cursor)
+            self._tasks.append(asyncio.create_task(
+                self._work(cursor, JaccardIndex(cursor, self._index), f"{self._ns}{worker}")
+            ))
+        return self
+
+    async def close(self):
+        # the workers fail the requests of their batches and wait for their running queries before they stop, so
+        # that no request is left pending and no cursor is closed under a query
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        while self._queue is not None and not self._queue.empty():
+            _closed(self._queue.get_nowait())
+        for cursor in self._cursors:
+            cursor.close()
+        self._queue, self._tasks, self._cursors = None, [], []
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+        return False
+
+    async def match(self, records: list):
+        # records are (key, value) pairs, the result lists (key, indexed key, overlap, jaccard) for every match
+        if self._queue is None:
+            raise RuntimeError("the service is not started")
+        request = _Request(list(records), asyncio.get_running_loop().create_future())
+        if not request.records:
+            return []
+        await self._queue.put(request)
+        return await request.future
+
+    async def _work(self, cursor: duckdb.DuckDBPyConnection, index: JaccardIndex, view: str):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = []
+            try:
+                await self._batch(loop, batch)
+                # the join runs in a thread, DuckDB releases the GIL meanwhile and the loop keeps taking requests
+                query = asyncio.ensure_future(asyncio.to_thread(self._join, cursor, index, view, batch))
+                try:
+                    matches = await asyncio.shield(query)
+                except asyncio.CancelledError:
+                    # cancelling does not stop the thread: the query is interrupted, and holds on to the cursor
+                    # until it is over
+                    cursor.interrupt()
+                    await asyncio.gather(query, return_exceptions=True)
+                    raise
+            except asyncio.CancelledError:
+                for request in batch:
+                    _closed(request)
+                raise
+            except Exception as e:
+                for request in batch:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+                continue
+            self._counts['batches'] += 1
+            done = time.perf_counter()
+            for request, request_matches in zip(batch, matches):
+                if not request.future.done():
+                    request.future.set_result(request_matches)
+                self._latencies.append(done - request.start)
+                self._counts['requests'] += 1
+                self._counts['records'] += len(request.records)
+                self._counts['matches'] += len(request_matches)
+
+    async def _batch(self, loop: asyncio.AbstractEventLoop, batch: list):
+        # the first request opens the batch, the waiting ones join it at once and later ones until max_wait is over;
+        # batch is filled in place, so that the requests taken so far are known if the worker is cancelled meanwhile
+        batch.append(await self._queue.get())
+        size = len(batch[0].records)
+        deadline = loop.time() + self._max_wait
+        while size < self._max_batch:
+            if self._queue.empty():
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    request = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            else:
+                request = self._queue.get_nowait()
+            batch.append(request)
+            size += len(request.records)
+
+    def _join(self, cursor: duckdb.DuckDBPyConnection, index: JaccardIndex, view: str, batch: list):
+        import pyarrow as pa
+
+        # the records of the batch are numbered through, so that the keys of different requests never mix up
+        keys, values, owners = [], [], []
+        for i, request in enumerate(batch):
+            for key, value in request.records:
+                keys.append(key)
+                values.append(value)
+                owners.append(i)
+        cursor.register(view, pa.table({'id': pa.array(range(len(values)), pa.int64()), 'val': values}))
+        try:
+            rows = cursor.execute(
+                index.probe_query(view, 'id', 'val', self._t, scores=True) + " order by l_id, jaccard desc"
+            ).fetchall()
+        finally:
+            cursor.unregister(view)
+
+        matches = [[] for _ in batch]
+        for probe, indexed, overlap, jaccard in rows:
+            matches[owners[probe]].append((keys[probe], indexed, overlap, jaccard))
+        return matches
+
+    def stats(self):
+        # counts since the start and latency percentiles, in milliseconds, over the latest requests
+        latencies = sorted(self._latencies)
+
+        def percentile(p: float):
+            return latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000 if latencies else None
+
+        return {
+            **self._counts,
+            'records_per_batch': self._counts['records'] / self._counts['batches'] if self._counts['batches'] else 0.0,
+            'latency_ms': {
+                'p50': percentile(0.5),
+                'p90': percentile(0.9),
+                'p99': percentile(0.99),
+                'max': latencies[-1] * 1000 if latencies else None
+            }
+        }
+
+    async def serve(self, path: str):
+        # the service over a Unix socket, one JSON object per line each way: {"records": [[key, value], ...]} in,
+        # {"matches": [[key, indexed key, overlap, jaccard], ...]} or {"error": message} out; {"stats": true}
+        # returns stats(). Runs until cancelled
+        server = await asyncio.start_unix_server(self._client, path=path)
+        async with server:
+            await server.serve_forever()
+
+    async def _client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        async def answer(line: bytes):
+            try:
+                request = json.loads(line)
+                if request.get('stats'):
+                    return {'stats': self.stats()}
+                return {'matches': await self.match(tuple(record) for record in request['records'])}
+            except Exception as e:
+                return {'error': f"{type(e).__name__}: {e}"}
+
+        try:
+            while line := await reader.readline():
+                writer.write(json.dumps(await answer(line)).encode() + b"\n")
+                await writer.drain()
+        finally:
+            writer.close()
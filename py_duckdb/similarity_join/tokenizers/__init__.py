@@ -1,30 +1,48 @@
 class Tokenizer:
 
-    def __init__(self, query: str, return_set=True):
+    def __init__(self, query: str, return_set=True, distinct=False):
         # assuming queries use DuckDB's 'list_distinct()' to generate a set rather than a bag
         self.__query = query if return_set else query.replace("list_distinct", "")
+        self.return_set = return_set
+        # whether no record ever has the same token twice, which return_set alone does not tell of a query (e.g. one
+        # transforming the tokens after list_distinct()); the bitmap filter and the native engine need it
+        self.distinct = return_set and distinct
 
     def query(self, from_table, key, val):
         return self.__query.format(from_table=from_table, key=key, val=val)
 
+    def template(self):
+        return self.__query
+
+    def normalize(self, val):
+        # an expression of the join value that tokenizes exactly like it, so that records with equal normalized
+        # values have the same tokens (see jaccard_join's dedup)
+        return val
+
 
 class QGramsTokzr(Tokenizer):
 
     def __init__(self, q: int, return_set=True):
+        # the string is padded and lowercased once per record, every q-gram is then a plain substring of it
         super().__init__(
-            "select {key}, len(tks) as len, lower(unnest(tks)) as token "
+            "select {key}, len(tks) as len, unnest(tks) as token "
             "from ( "
             "select {key}, "
-            f"list_distinct(list_transform(generate_series(1, len({{val}}) + {q} - 1), x -> "
-            f"substring(concat(repeat('#', {q} - 1), "
-            "lower({val}), "
-            f"repeat('#', {q} - 1)),"
-            f"x, {q}))) as tks "
+            f"list_distinct(list_transform(generate_series(1, val_len + {q} - 1), x -> substring(padded, x, {q}))) as tks "
+            "from ( "
+            "select {key}, len({val}) as val_len, "
+            f"concat(repeat('#', {q} - 1), lower({{val}}), repeat('#', {q} - 1)) as padded "
             "from {from_table} "
+            ") "
             ") ",
-            return_set
+            return_set,
+            distinct=True
         )
 
+    def normalize(self, val):
+        # lowercasing first changes nothing, unless it changes the length of the string and so the q-grams
+        return f"(case when len(lower({val})) = len({val}) then lower({val}) else {val} end)"
+
 
 class DelimiterTokzr(Tokenizer):
 
@@ -32,14 +50,16 @@ class DelimiterTokzr(Tokenizer):
         if isinstance(separators, list):
             separators = set(separators)
         separators = f"""[{''.join(separators)}]"""
+        # the value is lowercased before it is split, so that a set holds every word once whatever its case
         super().__init__(
-            "select {key}, len(tks) as len, lower(unnest(tks)) as token "
+            "select {key}, len(tks) as len, unnest(tks) as token "
             "from ( "
             "select {key}, "
-            f"list_distinct(list_filter(str_split_regex({{val}}, '{separators}'), x -> trim(x) != '')) as tks """
+            f"list_distinct(list_filter(str_split_regex(lower({{val}}), '{separators}'), x -> trim(x) != '')) as tks """
             "from {from_table} "
             ") ",
-            return_set
+            return_set,
+            distinct=True
         )
 
 
@@ -0,0 +1,89 @@
+from collections import OrderedDict
+
+import duckdb
+
+from py_duckdb.similarity_join.default_names import *
+from py_duckdb.similarity_join.tokenizers import Tokenizer
+
+
+class TokenCache:
+
+    def __init__(self, con: duckdb.DuckDBPyConnection, max_rows: int = 10_000_000):
+        # tokenized relations kept as temp tables of con, evicted least recently used first
+        # once they hold more than max_rows tokens altogether
+        self._con = con
+        self._ns = scratch_namespace()
+        self._max_rows = max_rows
+        self._entries = OrderedDict()
+        self._rows = 0
+        self._next = 0
+        self.hits = 0
+        self.misses = 0
+
+    def tokenizer(self, tokenizer: Tokenizer):
+        return CachedTokzr(self, tokenizer)
+
+    def tokens(self, tokenizer: Tokenizer, from_table: str, key: str, val: str):
+        # the tokenizer is identified by its query template, which spells out q, the separators and return_set;
+        # the fingerprint catches any change to the rows of the source table since they were tokenized
+        fingerprint = self._con.execute(
+            f"select count(*), sum(hash({key}, {val})) from {from_table}"
+        ).fetchall()[0]
+        entry = (from_table, key, val, tokenizer.template(), fingerprint)
+
+        if entry in self._entries:
+            self.hits += 1
+            self._entries.move_to_end(entry)
+            return f"select * from {self._entries[entry][0]}"
+
+        self.misses += 1
+        table = f"{self._ns}{TOKENS_VIEW}_{self._next}"
+        self._next += 1
+        self._con.execute(
+            f"create temp table {table} as " + tokenizer.query(from_table=from_table, key=key, val=val)
+        )
+        rows = self._con.execute(f"select count(*) from {table}").fetchall()[0][0]
+
+        # the newest entry stays even when it alone is over the bound, it is the first to go at the next miss
+        while self._entries and self._rows + rows > self._max_rows:
+            self._evict()
+        self._entries[entry] = (table, rows)
+        self._rows += rows
+        return f"select * from {table}"
+
+    def _evict(self):
+        _, (table, rows) = self._entries.popitem(last=False)
+        self._con.execute(f"drop table if exists {table}")
+        self._rows -= rows
+
+    def clear(self):
+        while self._entries:
+            self._evict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def rows(self):
+        return self._rows
+
+    @property
+    def max_rows(self):
+        return self._max_rows
+
+
+class CachedTokzr(Tokenizer):
+
+    def __init__(self, cache: TokenCache, tokenizer: Tokenizer):
+        super().__init__(tokenizer.template())
+        self.return_set = tokenizer.return_set
+        self.distinct = tokenizer.distinct
+        self._cache = cache
+        self._tokenizer = tokenizer
+
+    def query(self, from_table, key, val):
+        # tokenizes on first use, later queries on the same unchanged relation read the cached tokens
+        return self._cache.tokens(self._tokenizer, from_table, key, val)
+
+    def normalize(self, val):
+        return self._tokenizer.normalize(val)
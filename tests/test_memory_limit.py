@@ -0,0 +1,26 @@
+import duckdb
+
+from benchmarks import datasets
+from py_duckdb.similarity_join import jaccard_join, QGramsTokzr, WhitespaceTokzr
+
+
+def _connect():
+    con = duckdb.connect()
+    con.execute("set enable_progress_bar = false")
+    con.register('records', datasets.synthetic(3000))
+    con.execute("create table l as select * from records")
+    return con
+
+
+def test_budgeted_join_restores_the_limit():
+    # a join over the budget of an earlier one must run as on a fresh connection: the budget is the join's alone
+    con = _connect()
+    limit = con.execute("select current_setting('memory_limit')").fetchall()[0][0]
+    jaccard_join(con, 'l', '', 'id', 'id', 'val', 'val', WhitespaceTokzr(), 0.8, 'budgeted', memory_limit='50MB')
+    assert con.execute("select current_setting('memory_limit')").fetchall()[0][0] == limit
+
+    jaccard_join(con, 'l', '', 'id', 'id', 'val', 'val', QGramsTokzr(3), 0.2, 'after')
+    fresh = _connect()
+    jaccard_join(fresh, 'l', '', 'id', 'id', 'val', 'val', QGramsTokzr(3), 0.2, 'after')
+    count = "select count(*) from after"
+    assert con.execute(count).fetchall() == fresh.execute(count).fetchall()